@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares the output of the parser with the output of the original implementation
+(before the dispatch table and the incremental parser state). xmlparser-reference.json
+holds (fragment, markup) pairs produced by the original parser: cases which broke
+before, like lists inside list items, and random fragments of nested lists, tables,
+headings, links and preformatted text.
+
+Run with: python -m unittest ConfluenceConverter.test_xmlparser
+"""
+
+import json
+import os
+import StringIO
+import unittest
+
+from ConfluenceConverter.xmlparser import parse
+
+REFERENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xmlparser-reference.json")
+
+
+def translate(fragment):
+    out = StringIO.StringIO()
+    parse(fragment, out)
+    return out.getvalue()
+
+
+class ReferenceOutputTest(unittest.TestCase):
+
+    def test_list_inside_list_item(self):
+        self.assertEqual(u" * \n\n x", translate(u"<ul><li><ul></ul><p>x</p></li></ul>"))
+
+    def test_reference_fragments(self):
+        with open(REFERENCE_FILE, "r") as f:
+            cases = json.load(f)
+
+        differences = [(fragment, expected, translate(fragment)) for fragment, expected in cases
+                       if translate(fragment) != expected]
+        self.assertEqual([], differences, "%d of %d fragments differ, the first one: %r" % (
+            len(differences), len(cases), differences[:1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,19 +21,16 @@ If not, write to the Free Software Foundation, Inc.,
 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA
 """
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
 #from MoinMoin import wikiutil
 from common import *
 from xmlread import Parser
 import re
 import sys
-import operator
 import htmlentitydefs
 import codecs
+import hashlib
+import os
+import xml.parsers.expat as expat
 
 # XML dialect syntax parsing.
 
@@ -135,6 +132,80 @@ macrotypes = {
 normalise_regexp_str = r"\s+"
 normalise_regexp = re.compile(normalise_regexp_str)
 
+class TagInfo:
+
+    """
+    Precomputed translation details for elements of a given name, so that each
+    element needs only one lookup in the tag_info table.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        # Element tracking.
+
+        self.is_list = list_tags.has_key(name)
+        self.is_preformatted = name in preformatted_tags
+        self.is_region = name in preformatted_tags or name in formatted_tags
+        self.is_tracked = name in preformatted_tags or name in single_level_tags
+        self.is_heading = name in headings
+        self.is_macro = name == "ac:macro"
+        self.forbids_macros = self.is_heading or name == "a"
+
+        # Conversions.
+
+        self.translate = tag_translators.get(name, ConfluenceXMLParser.translate_default)
+        self.conversion = tags.get(name)
+        self.simple = simple_tags.get(name)
+        self.simple_preformatted = simple_preformatted_tags.get(name)
+        self.list_item_conversion = list_tags.get(name)
+
+        # Postprocessing and layout.
+
+        self.resets_rows = name == "table"
+        self.resets_columns = name == "tr"
+        self.is_cell = name in ("th", "td")
+        self.is_row = name == "tr"
+        self.is_indented = name in indented_tags
+        self.is_block = name in block_tags
+        self.is_span_override = name in span_override_tags
+        self.is_body = name == "body"
+        self.is_list_item = name == "li"
+
+        # Whitespace normalisation.
+
+        if name in ("html", "body", "table", "tbody", "tr") or self.is_list:
+            self.replacement = ""
+        else:
+            self.replacement = " "
+
+tag_info = {}
+
+def get_tag_info(name):
+
+    "Return the TagInfo for 'name', creating it on first use."
+
+    info = tag_info.get(name)
+    if info is None:
+        info = tag_info[name] = TagInfo(name)
+    return info
+
+def register_macro(name, conversion=None, args=None, handler=None):
+
+    """
+    Register a Confluence macro 'name', either with a MoinMoin 'conversion'
+    template (see macrotypes) and optional 'args' (see macroargs), or with a
+    'handler' function taking the parser and the macro content and returning
+    the translated text.
+    """
+
+    if conversion is not None:
+        macrotypes[name] = conversion
+    if args is not None:
+        macroargs[name] = args
+    if handler is not None:
+        macro_handlers[name] = handler
+
 class ConfluenceXMLParser(Parser):
 
     "Handle content from Confluence 4 page revisions."
@@ -143,6 +214,12 @@ class ConfluenceXMLParser(Parser):
         Parser.__init__(self)
         self.out = out
 
+        # Tag details for the open elements and whether any of them has
+        # collected non-empty text so far.
+
+        self.infos = []
+        self.has_text = []
+
         # Link target and label information.
 
         self.target = None
@@ -164,6 +241,12 @@ class ConfluenceXMLParser(Parser):
         for name in preformatted_tags + single_level_tags:
             self.states[name] = 0
 
+        # The number of open preformatted elements and elements forbidding
+        # macros (headings and links).
+
+        self.preformatted = 0
+        self.macros_forbidden = 0
+
         # Table states.
 
         self.table_rows = 0
@@ -176,21 +259,28 @@ class ConfluenceXMLParser(Parser):
     # ContentHandler-related methods.
 
     def startElement(self, name, attrs):
+        info = tag_info.get(name) or get_tag_info(name)
+        self.infos.append(info)
 
         # Track indentation for lists.
 
-        if list_tags.has_key(name):
+        if info.is_list:
             self.indents.append(self.indents[-1] + 1)
 
         # Track element nesting.
 
-        if self.states.has_key(name):
+        if info.is_tracked:
             self.states[name] += 1
+            if info.is_preformatted:
+                self.preformatted += 1
+
+        if info.forbids_macros:
+            self.macros_forbidden += 1
 
         # Track cumulative element nesting in order to produce appropriate depth
         # indicators in the formatted output.
 
-        if name in preformatted_tags or name in formatted_tags:
+        if info.is_region:
             self.level += 1
             self.max_level = max(self.level, self.max_level)
 
@@ -198,53 +288,66 @@ class ConfluenceXMLParser(Parser):
 
             self.indents.append(0)
 
-        if name in headings:
+        if info.is_heading:
             self.held_anchors = []
 
         Parser.startElement(self, name, attrs)
+        self.has_text.append(False)
 
         # Remember macro information for use within the element.
 
-        if name == "ac:macro":
+        if info.is_macro:
             self.macros.append(self.attributes[-1].get("ac:name"))
             self.macro_parameters.append({})
 
     def endElement(self, name):
+        info = self.infos[-1]
 
         # Reset the indent for any preformatted/formatted region so that it may
         # itself be indented.
 
-        if name in preformatted_tags or name in formatted_tags:
+        if info.is_region:
             self.indents.pop()
 
         Parser.endElement(self, name)
 
-        if list_tags.has_key(name):
+        if info.is_list:
             self.indents.pop()
 
-        if self.states.has_key(name):
+        if info.is_tracked:
             self.states[name] -= 1
+            if info.is_preformatted:
+                self.preformatted -= 1
 
-        if name in preformatted_tags or name in formatted_tags:
+        if info.forbids_macros:
+            self.macros_forbidden -= 1
+
+        if info.is_region:
             self.level -= 1
             if not self.level:
                 self.max_level = 0
 
         # Discard macro state.
 
-        if name == "ac:macro":
+        if info.is_macro:
             self.macros.pop()
             self.macro_parameters.pop()
 
+        self.infos.pop()
+        self.has_text.pop()
+
     def characters(self, content):
-        if not self.is_preformatted():
-            content = self.normalise(content, self.elements[-1])
+        if not self.preformatted:
+            content = normalise_regexp.sub(self.infos[-1].replacement, content)
+        if content:
+            self.has_text[-1] = True
         Parser.characters(self, content)
 
     def skippedEntity(self, name):
         ch = htmlentitydefs.name2codepoint.get(name)
         if ch:
             self.text[-1].append(unichr(ch))
+            self.has_text[-1] = True
 
     # Parser-related methods.
 
@@ -256,295 +359,427 @@ class ConfluenceXMLParser(Parser):
         example) or emitted in some form.
         """
 
+        info = self.infos[-1]
         text = u"".join(self.text[-1])
 
         # Handle state.
 
-        if name == "table":
+        if info.resets_rows:
             self.table_rows = 0
-        elif name == "tr":
+        elif info.resets_columns:
             self.table_columns = 0
 
-        # Find conversions.
+        # Convert the text using the translator for this kind of element.
 
-        conversion = None
+        text = info.translate(self, info, text)
 
-        # Handle list elements.
+        # Postprocess table columns and rows.
 
-        if name == "li" and len(self.elements) > 1:
-            list_tag = self.elements[-2]
-            conversion = list_tags.get(list_tag)
+        if info.is_cell:
+            if self.table_columns:
+                # text = "\n|| %s" % text
+                text = "||%s" % text
+            self.table_columns += 1
+        elif info.is_row:
+            if self.table_rows:
+                # text = "\n==\n%s" % text
+                text = "||\n||%s" % text
+            self.table_rows += 1
 
-        # Remember link target information.
+        # Postprocess held anchor tags in headings.
 
-        elif link_target_tags.has_key(name):
-            target_details = []
+        elif info.is_heading and self.held_anchors:
+            text = "%s\n%s" % ("".join(self.held_anchors), text)
 
-            # Get target details from the element's attributes.
+        # Normalise leading whitespace and indent the text if appropriate.
 
-            for attrname in link_target_tags[name]:
-                attrvalue = self.attributes[-1].get(attrname)
-                if attrvalue:
+        if info.is_indented:
+            text = " " * self.indents[-1] + text.lstrip()
 
-                    # Obtain a link label.
+        # Add the converted text to the end of the parent element's text nodes.
 
-                    if attrname in link_label_attributes and not self.label:
-                        self.label = attrvalue
+        if len(self.text) > 1:
+            nodes = self.text[-2]
+            parent = self.infos[-2]
 
-                    # Validate any page title.
+            # Where preceding text exists, add any blank line separators.
 
-                    if attrname == "ri:content-title":
-                        attrvalue = get_page_title(attrvalue)
-                    target_details.append(attrvalue)
+            if self.has_text[-2]:
 
-                    # Insert any prefix required for the link.
+                # All top-level elements are separated with blank lines.
 
-                    prefix = link_target_prefixes.get(attrname)
-                    if prefix:
-                        target_details.insert(0, prefix)
+                if parent.is_body:
+                    nodes.append("\n")
 
-            # Make a link based on the details.
+                # Block elements always cause a new line to be started.
 
-            self.target = u"/".join(target_details)
-            self.target_type = name
-            text = ""
+                if info.is_block or self.have_block and not info.is_span_override:
+                    nodes.append("\n")
 
-        # For anchor links, just use the raw text and let Moin do the formatting.
-        # Set an empty default target, overwriting it if enclosing elements
-        # specify target details.
+                self.have_block = False
 
-        elif name == "ac:link-body":
-            self.target = self.target or ""
-            self.label = text.strip()
-            text = ""
+            # Lists inside lists require separation.
 
-        # For conventional links, remember the href attribute as the target.
+            elif info.is_list and parent.is_list_item:
+                nodes.append("\n")
+                self.has_text[-2] = True
 
-        elif name == "a":
-            self.target = self.attributes[-1].get("href")
-            self.label = text.strip()
-            text = ""
+            # Without preceding text, save any block node state for non-block
+            # elements so that newline separators can be added at another
+            # level.
 
-        # Remember macro information.
+            elif info.is_block and not parent.is_block:
+                self.have_block = True
 
-        elif name == "ac:parameter":
-            self.macro_parameters[-1][self.attributes[-1].get("ac:name")] = text
-            text = ""
+            elif not info.is_block and self.have_block and not info.is_span_override:
+                self.have_block = True
 
-        elif name == "ac:default-parameter":
-            self.macro_parameters[-1][self.attributes[-2].get("ac:name")] = text
-            text = ""
+            else:
+                self.have_block = False
 
-        # Handle single-level tags.
+            nodes.append(text)
+            if text:
+                self.has_text[-2] = True
 
-        elif name in single_level_tags and self.states[name] > 1:
-            conversion = "%s"
+        # Otherwise, emit the text (at the top level of the document).
 
-        # Handle preformatted sections.
+        else:
+            self.out.write(text)
 
-        elif name in preformatted_tags or name in formatted_tags:
+    # Element translators, selected by the tag_translators table.
 
-            # Nest the section appropriately.
+    def convert_text(self, info, text, conversion):
 
-            level = 3 + self.max_level - self.level
-            opening = "{" * level
-            closing = "}" * level
+        "Handle the common cases for parameterised and unparameterised substitutions."
 
-            # Macro name information is used to style rich text body regions.
+        if text and conversion:
+            return conversion % text
+        elif info.simple is not None and not self.preformatted:
+            return info.simple
+        elif info.simple_preformatted is not None and self.preformatted:
+            return info.simple_preformatted
+        return text
 
-            if name != "table" and self.macros and macro_rich_text_styles.has_key(self.macros[-1]):
-                details = macro_rich_text_styles[self.macros[-1]]
-                title = self.macro_parameters[-1].get("title")
-                if title:
-                    details = "%s\n\n%s" % (details, title)
+    def translate_default(self, info, text):
+        return self.convert_text(info, text, info.conversion)
 
-                conversion = "%s#!wiki %s\n\n%%s\n%s" % (opening, details, closing)
+    def translate_list_item(self, info, text):
+        conversion = None
+        if len(self.elements) > 1:
+            conversion = self.infos[-2].list_item_conversion
+        return self.convert_text(info, text, conversion or info.conversion)
 
-            elif name == "table":
-                #conversion = "%s#!table\n%%s\n%s" % (opening, closing)
-                conversion = "||%s||"
+    def translate_link_target(self, info, text):
 
-            else:
-                # Preformatted sections containing newlines must contain an initial
-                # newline.
+        "Remember link target information."
 
-                if text.find("\n") != -1 and not text.startswith("\n"):
-                    opening += "\n"
+        target_details = []
 
-                conversion = "%s%%s%s" % (opening, closing)
+        # Get target details from the element's attributes.
 
-        # Handle the common case and simpler special cases.
+        for attrname in link_target_tags[info.name]:
+            attrvalue = self.attributes[-1].get(attrname)
+            if attrvalue:
 
-        if not conversion:
-            conversion = tags.get(name)
+                # Obtain a link label.
 
+                if attrname in link_label_attributes and not self.label:
+                    self.label = attrvalue
 
+                # Validate any page title.
 
-        # Attempt to convert the text.
+                if attrname == "ri:content-title":
+                    attrvalue = get_page_title(attrvalue)
+                target_details.append(attrvalue)
 
-        # Links require target information.
+                # Insert any prefix required for the link.
 
-        if name in ("ac:link", "ac:image"):
-            prefix = link_target_types.get(self.target_type, "")
-            anchor = self.attributes[-1].get("ac:anchor") or ""
-            label = self.label or text.strip() or self.target
-            text = conversion % (prefix, self.target, anchor and ("#%s" % anchor) or "", label)
-            self.target = self.target_type = self.label = None
+                prefix = link_target_prefixes.get(attrname)
+                if prefix:
+                    target_details.insert(0, prefix)
 
-        elif name == "a":
-            text = conversion % (self.target, self.label or self.target)
-            self.target = self.target_type = self.label = None
+        # Make a link based on the details.
 
-        # Macros require various kinds of information.
-        # Some macros affect the formatting of their contents, whereas other
-        # simpler macros are handled here.
+        self.target = u"/".join(target_details)
+        self.target_type = info.name
+        return self.convert_text(info, "", info.conversion)
 
-        elif name == "ac:macro":
-            # special handling for this macro, because sometimes some attributes are missing
-            if self.macros[-1] == "status":
-                parameters = {"content" : text}
-                color = self.macro_parameters[-1].get("colour") or "grey"
-                color = color.lower()
-                title = self.macro_parameters[-1].get("title") or "-"
-                text = "{{{#!wiki macro-status/status-%s\n%s\n}}}" % (color, title)
-            else:
-                conversion = macrotypes.get(self.macros[-1])
-                if conversion:
-                    parameters = {"content" : text}
-                    parameters.update(self.macro_parameters[-1])
-                    argnames = macroargs.get(self.macros[-1])
-                    if argnames:
-                        confargname, moinargname = argnames
-                        parameters["args"] = quote_macro_argument("%s=%s" % (moinargname, self.macro_parameters[-1][confargname]))
-                    text = conversion % parameters
-                    if self.macros[-1] == "anchor" and self.forbids_macros():
-                        self.held_anchors.append(text)
-                        text = ""
-
-        # Handle the common cases for parameterised and unparameterised
-        # substitutions.
-
-        elif text and conversion:
-            text = conversion % text
-        elif simple_tags.has_key(name) and not self.is_preformatted():
-            text = simple_tags[name]
-        elif simple_preformatted_tags.has_key(name) and self.is_preformatted():
-            text = simple_preformatted_tags[name]
+    def translate_link_body(self, info, text):
 
+        """
+        For anchor links, just use the raw text and let Moin do the formatting.
+        Set an empty default target, overwriting it if enclosing elements
+        specify target details.
+        """
 
+        self.target = self.target or ""
+        self.label = text.strip()
+        return self.convert_text(info, "", info.conversion)
 
-        # Postprocess table columns and rows.
+    def translate_anchor(self, info, text):
 
-        if name in ("th", "td"):
-            if self.table_columns:
-                # text = "\n|| %s" % text
-                text = "||%s" % text
-            self.table_columns += 1
-        elif name == "tr":
-            if self.table_rows:
-                # text = "\n==\n%s" % text
-                text = "||\n||%s" % text
-            self.table_rows += 1
+        "For conventional links, remember the href attribute as the target."
 
-        # Postprocess held anchor tags in headings.
+        self.target = self.attributes[-1].get("href")
+        self.label = text.strip()
+        text = info.conversion % (self.target, self.label or self.target)
+        self.target = self.target_type = self.label = None
+        return text
 
-        elif name in headings and self.held_anchors:
-            text = "%s\n%s" % ("".join(self.held_anchors), text)
+    def translate_parameter(self, info, text):
 
+        "Remember macro information."
 
+        self.macro_parameters[-1][self.attributes[-1].get("ac:name")] = text
+        return self.convert_text(info, "", info.conversion)
 
-        # Normalise leading whitespace and indent the text if appropriate.
+    def translate_default_parameter(self, info, text):
+        self.macro_parameters[-1][self.attributes[-2].get("ac:name")] = text
+        return self.convert_text(info, "", info.conversion)
 
-        if name in indented_tags:
-            text = " " * self.indents[-1] + text.lstrip()
+    def translate_single_level(self, info, text):
 
-        # Add the converted text to the end of the parent element's text nodes.
+        "Handle single-level tags."
 
-        if len(self.text) > 1:
-            nodes = self.text[-2]
-            parent = self.elements[-2]
+        if self.states[info.name] > 1:
+            return self.convert_text(info, text, "%s")
+        return self.convert_text(info, text, info.conversion)
 
-            # Where preceding text exists, add any blank line separators.
+    def translate_region(self, info, text):
 
-            if u"".join(nodes):
+        "Handle preformatted sections."
 
-                # All top-level elements are separated with blank lines.
+        # Nest the section appropriately.
 
-                if parent == "body":
-                    nodes.append("\n")
+        level = 3 + self.max_level - self.level
+        opening = "{" * level
+        closing = "}" * level
 
-                # Block elements always cause a new line to be started.
+        # Macro name information is used to style rich text body regions.
 
-                if name in block_tags or self.have_block and name not in span_override_tags:
-                    nodes.append("\n")
+        if info.name != "table" and self.macros and macro_rich_text_styles.has_key(self.macros[-1]):
+            details = macro_rich_text_styles[self.macros[-1]]
+            title = self.macro_parameters[-1].get("title")
+            if title:
+                details = "%s\n\n%s" % (details, title)
 
-                self.have_block = False
+            conversion = "%s#!wiki %s\n\n%%s\n%s" % (opening, details, closing)
 
-            # Lists inside lists require separation.
+        elif info.name == "table":
+            #conversion = "%s#!table\n%%s\n%s" % (opening, closing)
+            conversion = "||%s||"
 
-            elif list_tags.has_key(name) and parent == "li":
-                nodes.append("\n")
+        else:
+            # Preformatted sections containing newlines must contain an initial
+            # newline.
 
-            # Without preceding text, save any block node state for non-block
-            # elements so that newline separators can be added at another
-            # level.
+            if text.find("\n") != -1 and not text.startswith("\n"):
+                opening += "\n"
 
-            elif name in block_tags and parent not in block_tags:
-                self.have_block = True
+            conversion = "%s%%s%s" % (opening, closing)
 
-            elif name not in block_tags and self.have_block and name not in span_override_tags:
-                self.have_block = True
+        return self.convert_text(info, text, conversion)
 
-            else:
-                self.have_block = False
+    def translate_link(self, info, text):
 
-            nodes.append(text)
+        "Links require target information."
 
-        # Otherwise, emit the text (at the top level of the document).
+        prefix = link_target_types.get(self.target_type, "")
+        anchor = self.attributes[-1].get("ac:anchor") or ""
+        label = self.label or text.strip() or self.target
+        text = info.conversion % (prefix, self.target, anchor and ("#%s" % anchor) or "", label)
+        self.target = self.target_type = self.label = None
+        return text
 
-        else:
-            self.out.write(text)
+    def translate_macro(self, info, text):
+
+        """
+        Macros require various kinds of information.
+        Some macros affect the formatting of their contents, whereas other
+        simpler macros are handled here.
+        """
+
+        handler = macro_handlers.get(self.macros[-1])
+        if handler:
+            return handler(self, text)
+
+        conversion = macrotypes.get(self.macros[-1])
+        if conversion:
+            parameters = {"content" : text}
+            parameters.update(self.macro_parameters[-1])
+            argnames = macroargs.get(self.macros[-1])
+            if argnames:
+                confargname, moinargname = argnames
+                parameters["args"] = quote_macro_argument("%s=%s" % (moinargname, self.macro_parameters[-1][confargname]))
+            text = conversion % parameters
+            if self.macros[-1] == "anchor" and self.forbids_macros():
+                self.held_anchors.append(text)
+                text = ""
+        return text
+
+    def translate_status_macro(self, text):
+
+        "Special handling for this macro, because sometimes some attributes are missing."
+
+        color = self.macro_parameters[-1].get("colour") or "grey"
+        color = color.lower()
+        title = self.macro_parameters[-1].get("title") or "-"
+        return "{{{#!wiki macro-status/status-%s\n%s\n}}}" % (color, title)
 
     def is_preformatted(self):
-        return reduce(operator.or_, [self.states[tag] for tag in preformatted_tags], False)
+        return self.preformatted > 0
 
     def forbids_macros(self):
-        return reduce(operator.or_, [(tag in headings or tag == "a") for tag in self.elements], False)
+        return self.macros_forbidden > 0
+
+# Element translators for tags not handled by translate_default.
+
+tag_translators = {
+    "li"                    : ConfluenceXMLParser.translate_list_item,
+    "ac:link-body"          : ConfluenceXMLParser.translate_link_body,
+    "a"                     : ConfluenceXMLParser.translate_anchor,
+    "ac:parameter"          : ConfluenceXMLParser.translate_parameter,
+    "ac:default-parameter"  : ConfluenceXMLParser.translate_default_parameter,
+    "ac:link"               : ConfluenceXMLParser.translate_link,
+    "ac:image"              : ConfluenceXMLParser.translate_link,
+    "ac:macro"              : ConfluenceXMLParser.translate_macro,
+    }
 
-    # Whitespace normalisation.
+for tag in link_target_tags.keys():
+    tag_translators[tag] = ConfluenceXMLParser.translate_link_target
 
-    def get_replacement(self, name):
-        if name in ("html", "body", "table", "tbody", "tr") or list_tags.has_key(name):
-            return ""
-        else:
-            return " "
+for tag in single_level_tags:
+    tag_translators[tag] = ConfluenceXMLParser.translate_single_level
 
-    def normalise(self, text, name):
-        return normalise_regexp.sub(self.get_replacement(name), text)
+for tag in preformatted_tags + formatted_tags:
+    tag_translators[tag] = ConfluenceXMLParser.translate_region
 
-def parse(s, out):
+# Macros needing more than a macrotypes conversion.
 
-    "Parse the content in the string 's', writing a translation to 'out'."
+macro_handlers = {
+    "status"                : ConfluenceXMLParser.translate_status_macro,
+    }
 
-    # NOTE: CDATA sections appear to have erroneous endings.
-    s = s.replace("]] >", "]]>")
-    s = u"""\
+# The document wrapped around each page body, encoded only once.
+
+document_prologue = u"""\
 <?xml version="1.0"?>
 <!DOCTYPE html 
      PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
      "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml">
 <body>
-%s
+""".encode("utf-8")
+
+document_epilogue = u"""
 </body>
-</html>""" % s
-
-    f = StringIO(s.encode("utf-8"))
-    try:
-        parser = ConfluenceXMLParser(out)
-        parser.parse(f)
-    finally:
-        f.close()
+</html>""".encode("utf-8")
+
+# The amount of data given to expat at once. This is the buffer size used by
+# xml.sax.expatreader, which determines where character data is split into
+# separate events (and so the normalised output).
+
+feed_size = 2**16 - 20
+
+def ignore_external_entity(context, base, sysid, pubid):
+    return 1
+
+def make_expat_parser(handler):
+
+    """
+    Return an expat parser set up like the SAX expat reader without external
+    general entities, sending its events directly to 'handler'.
+    """
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler = handler.endElement
+    parser.CharacterDataHandler = handler.characters
+    parser.ProcessingInstructionHandler = handler.processingInstruction
+    parser.SkippedEntityHandler = lambda name, is_pe: handler.skippedEntity(is_pe and "%" + name or name)
+    parser.ExternalEntityRefHandler = ignore_external_entity
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+    return parser
+
+def document_chunks(s):
+
+    """
+    Generate the encoded document for the body 's' in pieces, without building
+    the whole document.
+    """
+
+    yield document_prologue
+
+    # NOTE: CDATA sections appear to have erroneous endings.
+    # The fix-up is applied per piece, keeping back the end of each piece in
+    # case an erroneous ending is split.
+
+    held = u""
+    for start in xrange(0, len(s), feed_size):
+        text = (held + s[start:start + feed_size]).replace("]] >", "]]>")
+        held = text[-3:]
+        yield text[:-3].encode("utf-8")
+
+    yield held.encode("utf-8")
+    yield document_epilogue
+
+def feed_chunks(chunks):
+
+    "Regroup the byte strings from 'chunks' into pieces of exactly feed_size bytes."
+
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        offset = 0
+        while len(chunk) - offset >= feed_size - pending_size:
+            end = offset + feed_size - pending_size
+            pending.append(chunk[offset:end])
+            yield "".join(pending)
+            pending = []
+            pending_size = 0
+            offset = end
+        if offset < len(chunk):
+            pending.append(chunk[offset:])
+            pending_size += len(chunk) - offset
+    if pending:
+        yield "".join(pending)
+
+def get_translator_version():
+
+    """
+    Return a hash of the translation tables and of the parser sources, which
+    changes whenever the translation of a page may change.
+    """
+
+    h = hashlib.sha1()
+    for table in (tags, simple_tags, simple_preformatted_tags, list_tags,
+                  preformatted_tags, single_level_tags, formatted_tags,
+                  indented_tags, block_tags, span_override_tags,
+                  link_target_tags, link_target_prefixes, link_label_attributes,
+                  link_target_types, macro_rich_text_styles, macroargs, macrotypes,
+                  sorted(macro_handlers.keys()), sorted(tag_translators.keys())):
+        if isinstance(table, dict):
+            table = sorted(table.items())
+        h.update(repr(table))
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in ("common", "xmlread", "xmlparser"):
+        f = open(os.path.join(directory, module + ".py"), "rb")
+        try:
+            h.update(f.read())
+        finally:
+            f.close()
+
+    return h.hexdigest()
+
+def parse(s, out):
+
+    "Parse the content in the string 's', writing a translation to 'out'."
+
+    parser = make_expat_parser(ConfluenceXMLParser(out))
+    for data in feed_chunks(document_chunks(s)):
+        parser.Parse(data, 0)
+    parser.Parse("", 1)
 
 if __name__ == "__main__":
     s = codecs.getreader("utf-8")(sys.stdin).read()
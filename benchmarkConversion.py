@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Converts an export (e.g. one made by generateTestExport.py) and measures each stage of the
+conversion: loading the xml file, building the model (page tree), translating the markup
+and writing the pages and attachments.
+
+The results can be written as json and compared with the results of an earlier run.
+"""
+
+import argparse
+import json
+import os
+from os.path import join
+import shutil
+import StringIO
+import sys
+import tempfile
+
+import config
+import copyutil
+from convertData import EntitiesLoader, MoinMoinUsers, MoinMoinWriter, Space, Page, BodyContent, Attachment
+from profiling import StageTimer
+from ConfluenceConverter.xmlparser import parse
+
+
+# differences below these are noise, whatever the tolerance
+MIN_DIFFERENCE = {"wall": 0.1, "maxRssMB": 5.0}
+
+
+class TranslatedMarkup():
+    """
+    Hands the markup of the translate stage to the MoinMoinWriter (like a MarkupCache),
+    so the write stage measures the writing only.
+    """
+
+    def __init__(self):
+        self.markups = {}
+
+    def get(self, body):
+        return self.markups.get(body)
+
+    def put(self, body, markup):
+        self.markups[body] = markup
+
+
+def translateBodies(pageIds, markup):
+    """
+    :return: the number of bytes of the translated markup
+    """
+    size = 0
+    for pageId in pageIds:
+        body = BodyContent.all[Page.all[pageId].contentId].body
+        out = StringIO.StringIO()
+        parse(body, out)
+        markup.put(body, out.getvalue())
+        size += len(out.getvalue())
+    return size
+
+
+def runBenchmark(exportPath, outputPath, copyMode):
+    """
+    :return: the results (counts and stages)
+    """
+    timer = StageTimer()
+
+    def load():
+        MoinMoinUsers(join(exportPath, "users"))
+        loader = EntitiesLoader()
+        loader.load(join(exportPath, "entities.xml"))
+        return loader
+
+    def buildModel():
+        Space.renameSpaces(config.SPACES)
+        Page.renameHomePages()
+        Page.buildHierarchy()
+
+    loader = timer.measure("load", load)
+    timer.measure("model", buildModel)
+
+    spaceIds = set([Space.getSpaceByKey(key).id for key in config.SPACES.values()])
+    pageIds = [page.id for page in Page.all.values() if page.spaceId in spaceIds]
+    markup = TranslatedMarkup()
+    markupBytes = timer.measure("translate", lambda: translateBodies(pageIds, markup))
+
+    writer = MoinMoinWriter(attachmentFolder=join(exportPath, "attachments"), outputFolder=outputPath,
+                            copyMode=copyMode, markupCache=markup)
+    timer.measure("write", lambda: writer.writePageForSpaces(config.SPACES.values()))
+
+    return {
+        "export": exportPath,
+        "xmlBytes": os.path.getsize(join(exportPath, "entities.xml")),
+        "objects": loader.objectCount,
+        "pages": len(pageIds),
+        "attachments": len(Attachment.all),
+        "markupBytes": markupBytes,
+        "stages": timer.stages,
+        "wall": sum([stage["wall"] for stage in timer.stages]),
+        "maxRssMB": timer.stages[-1]["maxRssMB"]
+    }
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    """
+    :return: the descriptions of all stages, which got slower or need more memory than allowed
+    """
+    regressions = []
+    baselineStages = dict((stage["name"], stage) for stage in baseline["stages"])
+    for stage in results["stages"]:
+        old = baselineStages.get(stage["name"])
+        if old is None:
+            continue
+        for key in ("wall", "maxRssMB"):
+            if stage[key] > old[key] * (1 + tolerance) and stage[key] - old[key] > MIN_DIFFERENCE[key]:
+                regressions.append("%s %s: %.2f -> %.2f" % (stage["name"], key, old[key], stage[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the conversion of an export')
+    parser.add_argument('exportPath', type=str, help='The folder with entities.xml, the attachments and the users (see generateTestExport.py).')
+    parser.add_argument('--outputPath', type=str, help='Where the pages are written (default: a temporary folder, removed afterwards).')
+    parser.add_argument('--attachmentCopyMode', choices=copyutil.COPY_MODES, default="copy", help='How the attachments are copied.')
+    parser.add_argument('--json', type=str, help='Write the results to this file ("-" for stdout).')
+    parser.add_argument('--baseline', type=str, help='Results of an earlier run (--json) to compare with, exits with 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed growth of time and memory per stage compared to the baseline.')
+    args = parser.parse_args()
+
+    outputPath = args.outputPath
+    if outputPath is None:
+        outputPath = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        results = runBenchmark(args.exportPath, outputPath, args.attachmentCopyMode)
+    finally:
+        if args.outputPath is None:
+            shutil.rmtree(outputPath)
+
+    if args.json == "-":
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        print("%(pages)d pages, %(attachments)d attachments, %(xmlBytes)d bytes xml" % results)
+        for stage in results["stages"]:
+            print("%(name)-10s wall %(wall)8.3fs  cpu %(cpu)8.3fs  max rss %(maxRssMB)8.1f MB" % stage)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compareWithBaseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions compared to %s:\n%s" % (args.baseline, "\n".join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loads an export (e.g. one made by generateTestExport.py) and measures the memory of the
+model: the number and the size of the spaces, pages, attachments and body contents (with
+everything they refer to, strings shared by several objects are counted once) and the peak
+memory of the process.
+
+The results can be written as json and compared with the results of an earlier run.
+"""
+
+import argparse
+import json
+import os
+from os.path import join
+import resource
+import sys
+import array
+
+from convertData import EntitiesLoader, MoinMoinUsers, Space, Page, BodyContent, Attachment
+
+MODEL_CLASSES = [Space, Page, Attachment, BodyContent]
+
+# differences below this are noise, whatever the tolerance
+MIN_DIFFERENCE = 1024 * 1024
+
+
+def sizeOf(obj, seen):
+    """
+    :param seen: ids of the objects already counted, other model objects are never followed
+    :return: the bytes of the object and of everything it refers to
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            if not isinstance(item, tuple(MODEL_CLASSES)):
+                size += sizeOf(item, seen)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeOf(key, seen) + sizeOf(value, seen)
+    elif isinstance(obj, (str, unicode, int, long, float, array.array)) or obj is None:
+        pass
+    else:
+        if hasattr(obj, "__dict__"):
+            size += sizeOf(obj.__dict__, seen)
+        for name in getattr(type(obj), "__slots__", ()):
+            value = getattr(obj, name, None)
+            if not isinstance(value, tuple(MODEL_CLASSES)):
+                size += sizeOf(value, seen)
+    return size
+
+
+def runBenchmark(exportPath):
+    """
+    :return: the results (counts and sizes of the model classes, peak memory)
+    """
+    MoinMoinUsers(join(exportPath, "users"))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    loader = EntitiesLoader()
+    loader.load(join(exportPath, "entities.xml"))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    seen = set()
+    classes = {}
+    for modelClass in MODEL_CLASSES:
+        objects = modelClass.all.values()
+        size = sum([sizeOf(obj, seen) for obj in objects])
+        classes[modelClass.__name__] = {
+            "objects": len(objects),
+            "bytes": size,
+            "bytesPerObject": size / max(1, len(objects))
+        }
+
+    return {
+        "export": exportPath,
+        "xmlBytes": os.path.getsize(join(exportPath, "entities.xml")),
+        "objects": loader.objectCount,
+        "classes": classes,
+        "modelBytes": sum([stats["bytes"] for stats in classes.values()]),
+        "loadRssMB": after - before,
+        "maxRssMB": after
+    }
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    """
+    :return: the changes of each class compared to the baseline and the descriptions of the
+        classes, which need more memory than allowed
+    """
+    changes = []
+    regressions = []
+    for name in sorted(results["classes"].keys()):
+        stats = results["classes"][name]
+        old = baseline["classes"].get(name)
+        if old is None:
+            continue
+        changes.append("%-12s %12d -> %12d bytes (%+.1f%%)" % (
+            name, old["bytes"], stats["bytes"], (stats["bytes"] - old["bytes"]) * 100.0 / max(1, old["bytes"])))
+        if stats["bytes"] > old["bytes"] * (1 + tolerance) and stats["bytes"] - old["bytes"] > MIN_DIFFERENCE:
+            regressions.append("%s bytes: %d -> %d" % (name, old["bytes"], stats["bytes"]))
+    changes.append("%-12s %12.1f -> %12.1f MB" % ("load rss", baseline["loadRssMB"], results["loadRssMB"]))
+    return changes, regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the memory of the model of an export')
+    parser.add_argument('exportPath', type=str, help='The folder with entities.xml and the users (see generateTestExport.py).')
+    parser.add_argument('--json', type=str, help='Write the results to this file ("-" for stdout).')
+    parser.add_argument('--baseline', type=str, help='Results of an earlier run (--json) to compare with, exits with 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed growth of the model size per class compared to the baseline.')
+    args = parser.parse_args()
+
+    results = runBenchmark(args.exportPath)
+
+    if args.json == "-":
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+        print("%(objects)d objects, %(xmlBytes)d bytes xml" % results)
+        for name in sorted(results["classes"].keys()):
+            stats = results["classes"][name]
+            print("%-12s %9d objects %12d bytes %8d bytes/object" % (name, stats["objects"], stats["bytes"], stats["bytesPerObject"]))
+        print("model %d bytes, load rss %.1f MB, max rss %.1f MB" % (results["modelBytes"], results["loadRssMB"], results["maxRssMB"]))
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        changes, regressions = compareWithBaseline(results, baseline, args.tolerance)
+        print("Compared to %s:\n%s" % (args.baseline, "\n".join(changes)))
+        if regressions:
+            print("Regressions:\n%s" % "\n".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times the Confluence markup translation (ConfluenceConverter.xmlparser.parse) on generated,
+table-heavy page bodies.
+
+With --scaling it checks that the translation time grows linearly with the number of table
+rows and with the nesting depth of the elements.
+"""
+
+import argparse
+import json
+import sys
+import time
+import StringIO
+
+from ConfluenceConverter.xmlparser import parse
+
+
+def makeTablePage(rows, columns):
+    cells = []
+    for row in range(rows):
+        cells.append("<tr>")
+        for column in range(columns):
+            if row == 0:
+                cells.append("<th>Column %d</th>" % column)
+            else:
+                cells.append("<td><p>Cell %d/%d with <strong>bold</strong> and <em>emphasised</em> text</p></td>" % (row, column))
+        cells.append("</tr>")
+
+    return u"<p>Some text before the table.</p><table><tbody>%s</tbody></table>" % "".join(cells)
+
+
+def makeNestedPage(depth):
+    """
+    'depth' nested elements within a heading, each holding an anchor macro.
+    """
+    anchor = '<ac:macro ac:name="anchor"><ac:default-parameter>a</ac:default-parameter></ac:macro>'
+    return u"<h2>%sx%s</h2>" % (("<span>" + anchor) * depth, "</span>" * depth)
+
+
+def timeParse(body, repeat):
+    """
+    :return: the best time of 'repeat' runs in seconds
+    """
+    best = None
+    for i in range(repeat):
+        out = StringIO.StringIO()
+        start = time.time()
+        parse(body, out)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+
+    return best
+
+
+def checkScaling(name, makePage, sizes, repeat, maxGrowth):
+    """
+    Translates pages of the given sizes, each twice as large as the previous one.
+
+    :return: True if the time never grew by more than 'maxGrowth' per doubling
+    """
+    linear = True
+    previous = None
+    for size in sizes:
+        seconds = timeParse(makePage(size), repeat)
+        if previous is None:
+            print("%-6s %6d: %.4fs" % (name, size, seconds))
+        else:
+            growth = seconds / max(previous, 1e-6)
+            print("%-6s %6d: %.4fs (x%.2f)" % (name, size, seconds, growth))
+            if growth > maxGrowth:
+                linear = False
+        previous = seconds
+
+    return linear
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the markup translation')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000], help='The table sizes (rows) to test')
+    parser.add_argument('--columns', type=int, default=5, help='The number of columns of each table')
+    parser.add_argument('--repeat', type=int, default=3, help='How often each page is translated, the best time counts')
+    parser.add_argument('--json', action='store_true', help='Print the results as json')
+    parser.add_argument('--scaling', action='store_true', help='Check that the time grows linearly with the rows and the nesting depth')
+    args = parser.parse_args()
+
+    if args.scaling:
+        # linear growth doubles the time per step, quadratic growth quadruples it
+        sizes = [1000, 2000, 4000, 8000]
+        rowsOk = checkScaling("rows", lambda rows: makeTablePage(rows, args.columns), sizes, args.repeat, 3.0)
+        depthOk = checkScaling("depth", makeNestedPage, sizes, args.repeat, 3.0)
+        if not (rowsOk and depthOk):
+            print("Translation time grows faster than linear!")
+            sys.exit(1)
+        print("ok")
+        sys.exit(0)
+
+    results = []
+    for rows in args.rows:
+        body = makeTablePage(rows, args.columns)
+        seconds = timeParse(body, args.repeat)
+        results.append({"rows": rows, "columns": args.columns, "bodyBytes": len(body), "seconds": seconds})
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        for result in results:
+            print("%(rows)6d rows x %(columns)d columns: %(seconds).4fs" % result)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Converts the users, pages and attachments in one run: the crowd backup and the confluence
+export are parsed once each and the user ids of the converted users are kept in memory,
+the user files are not read back.
+"""
+
+from os import makedirs
+from os.path import exists
+
+import convertData
+import convertCrowdUserToMoinMoin
+from profiling import StageTimer
+
+
+def convertUsers(crowdBackup, outputDir, threads=4):
+    """
+    :return: user name -> user id (= file name) of all users in the directory, like the index
+        read by convertData.py
+    """
+    if not exists(outputDir):
+        makedirs(outputDir)
+
+    converted = convertCrowdUserToMoinMoin.convertUsers(crowdBackup, outputDir, threads=threads)
+    filename, name = convertCrowdUserToMoinMoin.add_default_user(outputDir)
+    converted[filename] = name
+    # includes the users already in the directory, only the new user files are not read
+    index = convertCrowdUserToMoinMoin.writeUserIndex(outputDir, converted)
+
+    # utf-8 encoded names, as read from the index
+    users = {}
+    for name, userId in index.items():
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        users[name] = userId
+    return users
+
+
+if __name__ == '__main__':
+
+    parser = convertData.createArgumentParser(description='Convert users, pages and attachments')
+    parser.add_argument('--crowdBackup', type=str, help='The crowd backup file (xml), the users are converted into --convertedUserPath.')
+    parser.add_argument('--userThreads', type=int, default=4, help='The number of threads writing the user files.')
+    args = parser.parse_args()
+
+    if args.crowdBackup is None:
+        parser.error("--crowdBackup is required")
+    if args.ingestOnly:
+        parser.error("--ingestOnly can't be used here, use convertData.py")
+    convertData.checkArguments(parser, args)
+
+    timer = StageTimer()
+    with timer.stage("users"):
+        users = convertUsers(args.crowdBackup, args.convertedUserPath, threads=args.userThreads)
+
+    convertData.convert(args, users=users, timer=timer)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import time
 import calendar
 import re
 import argparse
+import json
+import sys
 import config
+import userindex
 
 __author__ = 'Holger Cremer'
 
@@ -37,6 +44,7 @@ enc_password={SSHA}brokenforconversion/broken==
 last_saved=$conversionTs$
 name=$name$
 """
+    TEMPLATE_VAR_RE = re.compile(r"\$(\w+)\$")
 
     def __init__(self, id, name, email, displayName, createdDate=None):
         self.conversionDate = datetime.now()
@@ -57,11 +65,8 @@ name=$name$
         }
 
     def getMoinMoinuserData(self):
-        userData = self.USER_TEMPLATE
-        for key, value in self.tplVars.items():
-            userData = userData.replace("$" + key + "$", str(value))
-
-        return userData
+        # all variables in one pass over the template
+        return self.TEMPLATE_VAR_RE.sub(lambda match: str(self.tplVars[match.group(1)]), self.USER_TEMPLATE)
 
     def getFilename(self):
         """
@@ -74,31 +79,101 @@ name=$name$
         return self.tplVars.get("name")
 
 
-def convertUsers(input, outputDir):
-    print("Converting users...")
+def iterElements(input, sectionTag, tag):
+    """
+    Parses the <tag> elements within the <sectionTag> elements (e.g. users/user) of the
+    backup one after the other. Every element is freed after it has been handled, the
+    elements of other sections right away.
+
+    :return: a generator of the elements
+    """
+    stack = []
+    for event, elem in ET.iterparse(input, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
 
-    tree = ET.parse(input)
-    root = tree.getroot()
+        stack.pop()
+        if elem.tag == tag and stack and stack[-1].tag == sectionTag:
+            yield elem
+            # drop the handled element from its section
+            stack[-1].clear()
+        elif len(stack) == 2:
+            # any other element below a section
+            stack[-1].clear()
 
-    for user in root.iter('user'):
-        isActive = user.find("active").text == "true"
+
+def iterUsers(input):
+    """
+    :return: a generator of (isActive, User), the User is None for inactive users
+    """
+    for elem in iterElements(input, "users", "user"):
+        isActive = elem.find("active").text == "true"
         if not isActive:
+            yield False, None
             continue
 
-        user = User(
-            id=user.find('id').text,
-            name=user.find('name').text.encode('utf-8'),
-            email=user.find('email').text,
-            displayName=user.find('displayName').text.encode('utf-8'),
-            createdDate=user.find('createdDate').text,
+        yield True, User(
+            id=elem.find('id').text,
+            name=elem.find('name').text.encode('utf-8'),
+            email=elem.find('email').text,
+            displayName=elem.find('displayName').text.encode('utf-8'),
+            createdDate=elem.find('createdDate').text,
         )
-        # encoding='utf-8'
-        with open(outputDir + "/" + user.getFilename(), "w") as file:
-            file.write(user.getMoinMoinuserData())
 
-        print("Converted: " + user.getName())
+
+def writeUserFile(outputDir, user):
+    # encoding='utf-8'
+    with open(outputDir + "/" + user.getFilename(), "w") as file:
+        file.write(user.getMoinMoinuserData())
+
+
+def convertUsers(input, outputDir, threads=4, batchSize=256, verbose=False):
+    """
+    Streams the users of the backup into MoinMoin user files. The files are written in
+    batches by a pool of threads, while the next batch is parsed.
+
+    :return: user file name -> user name of the converted users
+    """
+    print("Converting users...")
+    start = time.time()
+    converted = {}
+    inactive = 0
+
+    pool = ThreadPool(threads)
+    pending = None
+    batch = []
+    try:
+        for isActive, user in iterUsers(input):
+            if not isActive:
+                inactive += 1
+                continue
+
+            converted[user.getFilename()] = user.getName()
+            if verbose:
+                print("Converted: " + user.getName())
+            batch.append(user)
+            if len(batch) >= batchSize:
+                # at most two batches are kept in memory
+                if pending is not None:
+                    pending.get()
+                pending = pool.map_async(lambda user: writeUserFile(outputDir, user), batch)
+                batch = []
+
+        if pending is not None:
+            pending.get()
+        pool.map(lambda user: writeUserFile(outputDir, user), batch)
+    finally:
+        pool.close()
+        pool.join()
+
+    print("%d users converted, %d inactive users skipped (%.1fs)." % (len(converted), inactive, time.time() - start))
+    return converted
 
 def add_default_user(outputDir):
+    """
+    :return: the file name and the name of the default user
+    """
     now = datetime.now()
     default_user = User(
         id="9999999",
@@ -112,16 +187,106 @@ def add_default_user(outputDir):
         file.write(default_user.getMoinMoinuserData())
 
     print("Default user created.")
+    return default_user.getFilename(), default_user.getName()
 
-def listUsersForGroup(input, groupName):
-    print("Listing users for group " + groupName)
 
-    tree = ET.parse(input)
-    root = tree.getroot()
+def writeUserIndex(outputDir, converted):
+    """
+    Writes the name index read by convertData.py, the files of the converted users are not read again.
+
+    :return: user name -> user id of all users in the directory
+    """
+    users = userindex.scanFolder(outputDir, known=converted)
+    try:
+        userindex.writeIndex(outputDir, users)
+        print("User index written.")
+    except (OSError, IOError, UnicodeDecodeError) as e:
+        # convertData.py reads the user files then
+        print("Can't write the user index: %s" % e)
+    return users
+
+class MembershipIndex():
+    """
+    The members of all groups, read in one pass over the memberships of the backup.
+    """
+
+    def __init__(self):
+        # group name -> names of the direct members, in the order of the backup
+        self.users = {}
+        self.groups = {}
+
+    @classmethod
+    def fromBackup(cls, input):
+        index = cls()
+        for elem in iterElements(input, "memberships", "membership"):
+            membershipType = elem.find("membershipType")
+            isGroup = membershipType is not None and membershipType.text == "GROUP_GROUP"
+            index.add(elem.find("parentName").text, elem.find("childName").text, isGroup)
+        return index
+
+    def add(self, groupName, memberName, isGroup=False):
+        members = self.groups if isGroup else self.users
+        members.setdefault(groupName, []).append(memberName)
+
+    def hasGroup(self, groupName):
+        return self.users.has_key(groupName) or self.groups.has_key(groupName)
+
+    def getUsers(self, groupName):
+        return self.users.get(groupName, [])
 
-    for membership in root.findall("./memberships/membership"):
-        if membership.find("parentName").text == groupName:
-            print(" * %s" % membership.find("childName").text)
+    def getGroups(self, groupName):
+        return self.groups.get(groupName, [])
+
+    def getAllUsers(self, groupName):
+        """
+        :return: the users of the group and of all groups nested within, each user once
+        """
+        users = []
+        seenUsers = set()
+        # nested groups may form a cycle
+        seenGroups = set([groupName])
+        stack = [groupName]
+        while stack:
+            currentGroup = stack.pop()
+            for user in self.getUsers(currentGroup):
+                if user not in seenUsers:
+                    seenUsers.add(user)
+                    users.append(user)
+            # depth first, in the order of the backup
+            for group in reversed(self.getGroups(currentGroup)):
+                if group not in seenGroups:
+                    seenGroups.add(group)
+                    stack.append(group)
+
+        return users
+
+
+def listUsersForGroups(input, groupNames, transitive=False, format="text"):
+    index = MembershipIndex.fromBackup(input)
+
+    if format == "json":
+        result = {}
+        for groupName in groupNames:
+            result[groupName] = {"users": index.getUsers(groupName), "groups": index.getGroups(groupName)}
+            if transitive:
+                result[groupName]["allUsers"] = index.getAllUsers(groupName)
+        print(json.dumps(result, indent=1, sort_keys=True))
+        return
+
+    for groupName in groupNames:
+        print("Listing users for group " + groupName)
+        if not index.hasGroup(groupName):
+            print(" (no members)")
+            continue
+
+        if transitive:
+            users = index.getAllUsers(groupName)
+        else:
+            users = index.getUsers(groupName)
+        for user in users:
+            print(" * %s" % user.encode("utf-8"))
+        for group in index.getGroups(groupName):
+            print(" + %s (group)" % group.encode("utf-8"))
 
 
 if __name__ == '__main__':
@@ -130,13 +295,22 @@ if __name__ == '__main__':
     parser.add_argument('inputFile', type=str, help='The crowd backup file (xml)')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-convertUserTo', dest="users", type=str, metavar="directory", help='Convert the user and store them into this directory')
-    group.add_argument('-group', dest="group", type=str, metavar="groupname", help='The group to get the user names for')
+    group.add_argument('-group', dest="group", type=str, action='append', metavar="groupname", help='The group to get the user names for, may be given more than once')
+    parser.add_argument('-threads', dest="threads", type=int, default=4, help='The number of threads writing the user files')
+    parser.add_argument('-verbose', dest="verbose", action='store_true', help='Print every converted user')
+    parser.add_argument('-transitive', dest="transitive", action='store_true', help='List the users of nested groups as well')
+    parser.add_argument('-format', dest="format", choices=("text", "json"), default="text", help='The output format of the group members')
     args = parser.parse_args()
 
     if args.users:
-        convertUsers(args.inputFile, args.users)
-        add_default_user(args.users)
+        converted = convertUsers(args.inputFile, args.users, threads=args.threads, verbose=args.verbose)
+        filename, name = add_default_user(args.users)
+        converted[filename] = name
+        writeUserIndex(args.users, converted)
     elif args.group:
-        listUsersForGroup(args.inputFile, args.group)
+        listUsersForGroups(args.inputFile, args.group, transitive=args.transitive, format=args.format)
+        if args.format == "json":
+            # nothing else on stdout
+            sys.exit(0)
 
     print("\ndone")
@@ -2,26 +2,44 @@
 # -*- coding: utf-8 -*-
 
 """
-Converts the pages and attachments. No revisions or comments.
+Converts the pages and attachments. No comments. Only the current version of each page is
+converted, with --history all old versions of the pages are converted as MoinMoin revisions
+as well. Only the most recent version of each attachment is copied.
 """
 
 __author__ = 'holger'
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 import time
 import calendar
-from os import makedirs, listdir
+import os
+from os import remove, rename
 from os.path import join, exists, dirname
-import shutil
 import re
 import StringIO
 import urllib
 import argparse
-
-import codecs
+import sqlite3
+import json
+import hashlib
+import multiprocessing
+import threading
+import Queue
+import traceback
+import tempfile
+import array
 
 import wikiutil
 import config
+import copyutil
+import userindex
+from markupcache import MarkupCache
+from profiling import StageTimer, PageProfiler, writeReport
+from progress import ProgressReporter
+from output import DirectoryOutput, StagedOutput, ArchiveOutput
 from ConfluenceConverter.xmlparser import parse
 
 
@@ -31,7 +49,18 @@ def date_to_seconds(s):
 
 
 def getId(node):
-    return node.find("./id").text
+    # the ids of an export are numbers, an int is much smaller than a string
+    return int(node.find("./id").text)
+
+
+# strings repeated in many objects (space keys, titles, user names) are kept only once
+_strings = {}
+
+
+def internString(s):
+    if s is None:
+        return None
+    return _strings.setdefault(s, s)
 
 
 def getProp(node, name):
@@ -68,16 +97,21 @@ class IncompleteData(Exception):
     pass
 
 
-class Space():
+class Space(object):
+    __slots__ = ("id", "name", "key")
     all = {}
 
-    def __init__(self, spaceNode):
-        self.id = getId(spaceNode)
-        self.name = getPropText(spaceNode, "name")
-        self.key = getPropText(spaceNode, "key").lower()
+    def __init__(self, id, key, name):
+        self.id = id
+        self.name = name
+        self.key = internString(key.lower())
 
         Space.all[self.id] = self
 
+    @classmethod
+    def fromNode(cls, spaceNode):
+        return cls(getId(spaceNode), getPropText(spaceNode, "key"), getPropText(spaceNode, "name"))
+
     @classmethod
     def getSpaceByKey(cls, spaceKey):
         spaceKey = spaceKey.lower()
@@ -99,59 +133,88 @@ class Space():
             space.key = newKey
 
 
-class Page():
+class Page(object):
+    __slots__ = ("id", "spaceId", "parentId", "title", "contentId", "lastModifierName", "lastModifierId",
+                 "lastModificationDate", "attachments", "children", "fullName", "fsName")
     all = {}
     topPages = {}
+    # page id -> why the page has no place in the page tree, see buildHierarchy()
+    hierarchyErrors = {}
+
+    def __init__(self, id, spaceId, parentId, title, contentId, lastModifierName, lastModificationDate, attachments):
+        self.id = id
+        self.spaceId = spaceId
+        self.parentId = parentId
+        self.title = internString(title)
+        self.contentId = contentId
+        self.lastModifierName = internString(lastModifierName)
+        self.lastModifierId = MoinMoinUsers.getUserIdForName(lastModifierName)
+        self.lastModificationDate = lastModificationDate
+        # attachment ids
+        self.attachments = array.array("l", attachments)
+        # set by buildHierarchy()
+        self.children = []
+        self.fullName = None
+        self.fsName = None
 
-    def __init__(self, node):
+        Page.all[self.id] = self
+        if self.parentId is None:
+            # this page is a "Home" page
+            Page.topPages[self.id] = self
+
+    @classmethod
+    def fromNode(cls, node):
+        """
+        :return: the new page or None for old or deleted pages
+        """
         spaceProp = getProp(node, "space")
         if spaceProp is None:
             # only an old page
-            return
+            return None
 
         if getPropText(node, "contentStatus") != "current":
             # page may be deleted
-            return
+            return None
 
-        self.id = getId(node)
-        self.spaceId = getId(spaceProp)
+        id = getId(node)
         parent = getProp(node, "parent")
         if parent is not None:
-            self.parentId = getId(parent)
+            parentId = getId(parent)
         else:
-            self.parentId = None
-        self.title = getPropText(node, "title")
+            parentId = None
         # remove / from the page title
-        self.title = re.sub(r'/','-', self.title)
-        self.contentId = self._readBody(node)
-        name = getPropText(node, "lastModifierName")
-        self.lastModifierId = MoinMoinUsers.getUserIdForName(name)
-        self.lastModificationDate = date_to_seconds(getPropText(node, "lastModificationDate"))
-
-        self._readAttachments(node)
-
-        Page.all[self.id] = self
-        if self.parentId is None:
-            # this page is a "Home" page
-            Page.topPages[self.id] = self
-
+        title = re.sub(r'/','-', getPropText(node, "title"))
+
+        return cls(
+            id=id,
+            spaceId=getId(spaceProp),
+            parentId=parentId,
+            title=title,
+            contentId=cls._readBody(node, id),
+            lastModifierName=getPropText(node, "lastModifierName"),
+            lastModificationDate=date_to_seconds(getPropText(node, "lastModificationDate")),
+            attachments=cls._readAttachments(node)
+        )
 
-    def _readBody(self, node):
+    @staticmethod
+    def _readBody(node, id):
         collection = node.find("./collection[@name='bodyContents']")
-        if collection is None: raise BaseException("Page without body! " + self.id)
+        if collection is None: raise BaseException("Page without body! %s" % id)
         element = collection.find("./element[@class='BodyContent']")
-        if element is None: raise BaseException("Page without body! " + self.id)
+        if element is None: raise BaseException("Page without body! %s" % id)
         return getId(element)
 
-    def _readAttachments(self, node):
-        self.attachments = []
+    @staticmethod
+    def _readAttachments(node):
+        attachments = []
         collection = node.find("./collection[@name='attachments']")
         if collection is None:
-            return
+            return attachments
 
         for attElement in collection.findall("./element[@class='Attachment']"):
-            id = getId(attElement)
-            self.attachments.append(id)
+            attachments.append(getId(attElement))
+
+        return attachments
 
 
     def __str__(self):
@@ -167,198 +230,1192 @@ class Page():
                 continue
             # find space
             space = Space.all.get(page.spaceId)
-            if space is None: raise StandardError("No space found for 'Home' page id " + page.spaceId)
+            if space is None: raise StandardError("No space found for 'Home' page id %s" % page.spaceId)
             page.title = space.key
 
+    @classmethod
+    def buildHierarchy(cls):
+        """
+        Links every page to its children and sets the full MoinMoin name of each page
+        (e.g. "space/parent/page") together with its quoted file system name.
+
+        Pages with a missing parent or within a parent cycle get no name, the reason is
+        kept in hierarchyErrors.
+        """
+        cls.hierarchyErrors = {}
+        for page in cls.all.values():
+            page.children = []
+            page.fullName = None
+            page.fsName = None
+
+        for page in cls.all.values():
+            if page.parentId is None:
+                continue
+            parent = cls.all.get(page.parentId)
+            if parent is None:
+                cls.hierarchyErrors[page.id] = "No parent page %s found for page %s" % (page.parentId, page.id)
+            else:
+                parent.children.append(page)
+
+        stack = cls.topPages.values()
+        for page in stack:
+            page.fullName = page.title
+        while stack:
+            page = stack.pop()
+            page.fsName = wikiutil.quoteWikinameFS(page.fullName)
+            for child in page.children:
+                child.fullName = page.fullName + "/" + child.title
+                stack.append(child)
+
+        # everything not reached from a top page is below an orphan or part of a cycle
+        for page in cls.all.values():
+            if page.fullName is None and not cls.hierarchyErrors.has_key(page.id):
+                cls.hierarchyErrors[page.id] = cls._describeUnreachable(page)
+
+    @classmethod
+    def _describeUnreachable(cls, page):
+        path = [page.id]
+        currentPage = page
+        while True:
+            nextPage = cls.all.get(currentPage.parentId)
+            if nextPage is None:
+                return "No parent page %s found for page %s (ancestor of page %s)" % (
+                    currentPage.parentId, currentPage.id, page.id)
+            if nextPage.id in path:
+                path.append(nextPage.id)
+                return "Page %s is part of a parent cycle: %s" % (page.id, " -> ".join([str(pageId) for pageId in path]))
+            path.append(nextPage.id)
+            currentPage = nextPage
+
 
-class Attachment():
+class Attachment(object):
+    __slots__ = ("id", "filename", "lastModificationDate", "creatorName", "creatorNameId", "version", "originalVersion")
     all = {}
 
-    def __init__(self, node):
-        self.id = getId(node)
-        self.filename = getPropText(node, "fileName")
-        self.lastModificationDate = date_to_seconds(getPropText(node, "lastModificationDate"))
-        name = getPropText(node, "creatorName")
-        self.creatorNameId = MoinMoinUsers.getUserIdForName(name)
-        self.version = getPropText(node, "attachmentVersion")
+    def __init__(self, id, filename, lastModificationDate, creatorName, version, originalVersion):
+        self.id = id
+        self.filename = filename
+        self.lastModificationDate = lastModificationDate
+        self.creatorName = internString(creatorName)
+        self.creatorNameId = MoinMoinUsers.getUserIdForName(creatorName)
+        self.version = version
+        # the id of the current attachment, None if this is the current attachment itself
+        self.originalVersion = originalVersion
+
+        Attachment.all[self.id] = self
+
+    @classmethod
+    def fromNode(cls, node):
         original = getProp(node, "originalVersion")
         if original is None:
-            # this means that this is the most recent version
-            self.originalVersion = None
+            originalVersion = None
         else:
-            self.originalVersion = getId(node)
+            originalVersion = getId(original)
+
+        return cls(
+            id=getId(node),
+            filename=getPropText(node, "fileName"),
+            lastModificationDate=date_to_seconds(getPropText(node, "lastModificationDate")),
+            creatorName=getPropText(node, "creatorName"),
+            version=int(getPropText(node, "attachmentVersion")),
+            originalVersion=originalVersion
+        )
 
-        Attachment.all[self.id] = self
+    def getOriginalId(self):
+        if self.originalVersion is None:
+            return self.id
+        return self.originalVersion
 
     def __str__(self):
-        return self.id + "//" + print_safe(self.filename)
+        return "%s//%s" % (self.id, print_safe(self.filename))
 
 
-class BodyContent():
+class BodyContent(object):
+    __slots__ = ("id", "body")
     all = {}
 
-    def __init__(self, node):
-        self.id = getId(node)
+    def __init__(self, id, body):
+        self.id = id
+        self.body = body
+
+        BodyContent.all[self.id] = self
+
+    @classmethod
+    def fromNode(cls, node):
         body = getPropText(node, "body")
         if body is None:
             body = ""
-        self.body = body.strip()
-
-        BodyContent.all[self.id] = self
+        return cls(getId(node), body.strip())
 
     def __str__(self):
-        return self.id + "//" + self.body[0:10] + "..."
+        return "%s//%s..." % (self.id, print_safe(self.body[0:10]))
+
+
+class EntitiesLoader():
+    """
+    Streams the objects of a Confluence entities.xml file into the model classes.
+
+    Every top level <object> element is turned into its model object as soon as
+    it is closed and is freed afterwards, so the xml tree is never kept in memory.
+
+    If space keys are given, only pages of these spaces are kept. Body contents
+    and attachments of other pages are dropped while parsing. Objects referring
+    to a space or page that was not parsed yet are held back until it shows up.
+
+    With a HistoryStore the old page versions and all bodies not belonging to a
+    current page are written to the store instead of being dropped.
+
+    Only the most recent version of each attachment is listed in the attachments of its
+    page. Superseded versions are dropped as soon as a newer one shows up, unless a
+    HistoryStore is given.
+
+    A ProgressReporter gets the parsed objects and the position within the file.
+    """
+
+    def __init__(self, spaceKeys=None, historyStore=None, progress=None):
+        if spaceKeys is None:
+            self.spaceKeys = None
+        else:
+            self.spaceKeys = set([key.lower() for key in spaceKeys])
+
+        self.historyStore = historyStore
+        self.progress = progress
+        self.objectCount = 0
+        self.droppedCount = 0
+
+        self._selectedSpaceIds = set()
+        self._droppedPageIds = set()
+        # space id -> page nodes, page id -> (class, node) for contents and attachments
+        self._pendingPages = {}
+        self._pendingContents = {}
+        # id of the current attachment -> most recent version parsed so far
+        self._latestAttachments = {}
+
+        self._handlers = {
+            "Space": self._handleSpace,
+            "Page": self._handlePage,
+            "Attachment": self._handlePageContent,
+            "BodyContent": self._handlePageContent
+        }
+
+    def load(self, xmlInputFile):
+        with open(xmlInputFile, "rb") as xmlFile:
+            if self.progress is not None:
+                self.progress.startPhase("load", total=os.fstat(xmlFile.fileno()).st_size, unit="bytes")
+
+            root = None
+            depth = 0
+            for event, elem in ET.iterparse(xmlFile, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth != 1 or elem.tag != "object":
+                    continue
+
+                handler = self._handlers.get(elem.attrib["class"])
+                if handler is None or not handler(elem):
+                    # free the subtree, unless the node has been held back
+                    elem.clear()
+                # drop the reference the root element keeps
+                root.clear()
+                self.objectCount += 1
+                if self.progress is not None:
+                    self.progress.update(done=xmlFile.tell(), objects=self.objectCount)
+
+        self._finish()
+        self._latestAttachments = {}
+        if self.progress is not None:
+            self.progress.finishPhase()
+        if self.historyStore is not None:
+            self.historyStore.commit()
+
+    def _handleSpace(self, node):
+        space = Space.fromNode(node)
+        if self.spaceKeys is None or space.key in self.spaceKeys:
+            self._selectedSpaceIds.add(space.id)
+            accept = True
+        else:
+            accept = False
+
+        for pageNode in self._pendingPages.pop(space.id, []):
+            self._decidePage(pageNode, accept)
+
+    def _handlePage(self, node):
+        """
+        :return: True if the node has been held back
+        """
+        spaceProp = getProp(node, "space")
+        if spaceProp is None and self.historyStore is not None:
+            self._addPageVersion(node)
+
+        if spaceProp is None or self.spaceKeys is None:
+            # old pages are dropped by the Page class itself
+            self._decidePage(node, True)
+            return False
+
+        spaceId = getId(spaceProp)
+        if spaceId in self._selectedSpaceIds:
+            self._decidePage(node, True)
+        elif spaceId in Space.all:
+            self._decidePage(node, False)
+        else:
+            self._pendingPages.setdefault(spaceId, []).append(node)
+            return True
+
+        return False
+
+    def _addPageVersion(self, node):
+        original = getProp(node, "originalVersion")
+        if original is None or getPropText(node, "contentStatus") != "current":
+            return
+
+        self.historyStore.addVersion(
+            pageId=getId(original),
+            version=int(getPropText(node, "version")),
+            contentId=Page._readBody(node, getId(node)),
+            lastModifierName=getPropText(node, "lastModifierName"),
+            lastModificationDate=date_to_seconds(getPropText(node, "lastModificationDate"))
+        )
+
+    def _decidePage(self, node, accept):
+        pageId = getId(node)
+        if accept:
+            page = Page.fromNode(node)
+            accept = page is not None
+            if accept and self.historyStore is not None and not BodyContent.all.has_key(page.contentId):
+                # the body may have been spooled before the page showed up
+                body = self.historyStore.getBody(page.contentId)
+                if body is not None:
+                    BodyContent(page.contentId, body)
+
+        if not accept:
+            self._droppedPageIds.add(pageId)
+            self.droppedCount += 1
+
+        for objectClass, contentNode in self._pendingContents.pop(pageId, []):
+            if accept:
+                self._createContent(objectClass, contentNode)
+            else:
+                self.droppedCount += 1
+
+    def _handlePageContent(self, node):
+        """
+        Handles BodyContent and Attachment objects, depending on the page they belong to.
+
+        :return: True if the node has been held back
+        """
+        objectClass = Attachment if node.attrib["class"] == "Attachment" else BodyContent
+        pageId = self._getContentPageId(node)
+        if pageId is None or pageId in Page.all:
+            self._createContent(objectClass, node)
+        elif objectClass is BodyContent and self.historyStore is not None:
+            # might be the body of an old version, which are never kept in memory
+            body = getPropText(node, "body")
+            self.historyStore.addBody(getId(node), (body or "").strip())
+        elif pageId in self._droppedPageIds:
+            self.droppedCount += 1
+        else:
+            self._pendingContents.setdefault(pageId, []).append((objectClass, node))
+            return True
+
+        return False
+
+    def _createContent(self, objectClass, node):
+        content = objectClass.fromNode(node)
+        if objectClass is Attachment:
+            self._addAttachmentVersion(content, self._getContentPageId(node))
+
+    def _addAttachmentVersion(self, attachment, pageId):
+        """
+        Keeps the attachment, if it is the most recent version of its original. The page
+        lists the most recent version only, instead of any other version.
+        """
+        originalId = attachment.getOriginalId()
+        latest = self._latestAttachments.get(originalId)
+        if latest is None:
+            self._latestAttachments[originalId] = attachment
+            return
+
+        if attachment.version > latest.version:
+            latest, superseded = attachment, latest
+            self._latestAttachments[originalId] = latest
+        else:
+            superseded = attachment
+
+        if self.historyStore is None:
+            del Attachment.all[superseded.id]
+            self.droppedCount += 1
+
+        page = Page.all.get(pageId)
+        if page is not None and superseded.id in page.attachments:
+            position = page.attachments.index(superseded.id)
+            if latest.id in page.attachments:
+                del page.attachments[position]
+            else:
+                page.attachments[position] = latest.id
+
+    def _getContentPageId(self, node):
+        for name in ("content", "containerContent"):
+            prop = getProp(node, name)
+            if prop is not None and prop.find("./id") is not None:
+                return getId(prop)
+
+        return None
+
+    def _finish(self):
+        """
+        Resolves the objects whose space or page never showed up in the file.
+        """
+        for pageNodes in self._pendingPages.values():
+            for pageNode in pageNodes:
+                self._decidePage(pageNode, self.spaceKeys is None)
+        self._pendingPages = {}
+
+        for contents in self._pendingContents.values():
+            for objectClass, contentNode in contents:
+                if self.spaceKeys is None:
+                    self._createContent(objectClass, contentNode)
+                else:
+                    self.droppedCount += 1
+        self._pendingContents = {}
+
+
+class ModelStore():
+    """
+    Keeps the extracted spaces, pages, attachments and body contents in a SQLite database,
+    so later runs don't have to parse the xml export again.
+
+    The names of the users are stored, not their MoinMoin ids. They are resolved again
+    when the model is loaded.
+    """
+
+    SCHEMA = """
+        CREATE TABLE spaces (id INTEGER PRIMARY KEY, key TEXT NOT NULL, name TEXT);
+        CREATE TABLE pages (
+            id INTEGER PRIMARY KEY, spaceId INTEGER NOT NULL, parentId INTEGER, title TEXT NOT NULL,
+            contentId INTEGER NOT NULL, lastModifierName TEXT, lastModificationDate INTEGER NOT NULL);
+        CREATE TABLE pageAttachments (pageId INTEGER NOT NULL, position INTEGER NOT NULL, attachmentId INTEGER NOT NULL);
+        CREATE TABLE attachments (
+            id INTEGER PRIMARY KEY, filename TEXT, lastModificationDate INTEGER NOT NULL, creatorName TEXT,
+            version INTEGER, originalVersion INTEGER);
+        CREATE TABLE bodyContents (id INTEGER PRIMARY KEY, body TEXT NOT NULL);
+        CREATE INDEX spacesKey ON spaces (key);
+        CREATE INDEX pagesSpace ON pages (spaceId);
+        CREATE INDEX pagesParent ON pages (parentId);
+        CREATE INDEX pageAttachmentsPage ON pageAttachments (pageId, position);
+    """
+
+    TABLES = ["spaces", "pages", "pageAttachments", "attachments", "bodyContents"]
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self.db = sqlite3.connect(dbFile)
+
+    def close(self):
+        self.db.close()
+
+    def save(self):
+        """
+        Replaces the content of the database with the currently loaded model.
+        """
+        with self.db:
+            for table in ModelStore.TABLES:
+                self.db.execute("DROP TABLE IF EXISTS %s" % table)
+            self.db.executescript(ModelStore.SCHEMA)
+
+            self.db.executemany("INSERT INTO spaces VALUES (?, ?, ?)",
+                                ((space.id, space.key, space.name) for space in Space.all.values()))
+            self.db.executemany("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                ((page.id, page.spaceId, page.parentId, page.title, page.contentId,
+                                  page.lastModifierName, page.lastModificationDate) for page in Page.all.values()))
+            self.db.executemany("INSERT INTO pageAttachments VALUES (?, ?, ?)",
+                                ((page.id, position, attachmentId) for page in Page.all.values()
+                                 for position, attachmentId in enumerate(page.attachments)))
+            self.db.executemany("INSERT INTO attachments VALUES (?, ?, ?, ?, ?, ?)",
+                                ((att.id, att.filename, att.lastModificationDate, att.creatorName,
+                                  att.version, att.originalVersion) for att in Attachment.all.values()))
+            self.db.executemany("INSERT INTO bodyContents VALUES (?, ?)",
+                                ((content.id, content.body) for content in BodyContent.all.values()))
+
+    def load(self, spaceKeys=None):
+        """
+        Creates the model objects from the database. All spaces are loaded, but only the
+        pages (with their attachments and bodies) of the given space keys.
+        """
+        row = self.db.execute("SELECT typeof(id) FROM pages LIMIT 1").fetchone()
+        if row is not None and row[0] != "integer":
+            raise StandardError("%s has been written by an older version (text ids), please ingest the xml file again." % self.dbFile)
+
+        for row in self.db.execute("SELECT id, key, name FROM spaces"):
+            Space(*row)
+
+        if spaceKeys is None:
+            spaceFilter = ""
+            params = []
+        else:
+            params = [key.lower() for key in spaceKeys]
+            spaceFilter = " WHERE p.spaceId IN (SELECT id FROM spaces WHERE key IN (%s))" % ", ".join("?" * len(params))
+
+        attachments = {}
+        query = "SELECT a.pageId, a.attachmentId FROM pageAttachments a JOIN pages p ON p.id = a.pageId%s ORDER BY a.pageId, a.position"
+        for pageId, attachmentId in self.db.execute(query % spaceFilter, params):
+            attachments.setdefault(pageId, []).append(attachmentId)
+
+        query = "SELECT p.id, p.spaceId, p.parentId, p.title, p.contentId, p.lastModifierName, p.lastModificationDate FROM pages p%s"
+        for row in self.db.execute(query % spaceFilter, params):
+            Page(*row, attachments=attachments.get(row[0], []))
+
+        query = "SELECT DISTINCT t.id, t.filename, t.lastModificationDate, t.creatorName, t.version, t.originalVersion " \
+                "FROM attachments t JOIN pageAttachments a ON a.attachmentId = t.id JOIN pages p ON p.id = a.pageId%s"
+        for row in self.db.execute(query % spaceFilter, params):
+            Attachment(*row)
+
+        query = "SELECT b.id, b.body FROM bodyContents b JOIN pages p ON p.contentId = b.id%s"
+        for row in self.db.execute(query % spaceFilter, params):
+            BodyContent(*row)
+
+
+class HistoryStore():
+    """
+    Spools the old page versions and their bodies into a SQLite file while the export
+    is parsed, so the history of all pages is never kept in memory. The versions of
+    one page are read back when the page is written.
+    """
+
+    SCHEMA = """
+        DROP TABLE IF EXISTS versions;
+        DROP TABLE IF EXISTS bodies;
+        CREATE TABLE versions (
+            pageId INTEGER NOT NULL, version INTEGER NOT NULL, contentId INTEGER NOT NULL,
+            lastModifierName TEXT, lastModificationDate INTEGER NOT NULL);
+        CREATE TABLE bodies (id INTEGER PRIMARY KEY, body TEXT NOT NULL);
+        CREATE INDEX versionsPage ON versions (pageId, version);
+    """
+
+    def __init__(self, dbFile=None):
+        """
+        :param dbFile: the database file, a temporary file is used (and removed by close()) if None
+        """
+        self.temporary = dbFile is None
+        if self.temporary:
+            fd, dbFile = tempfile.mkstemp(prefix="history-", suffix=".db")
+            os.close(fd)
+        self.dbFile = dbFile
+        # (process id, thread id) -> connection
+        self._connections = {}
+
+        self._connect().executescript(HistoryStore.SCHEMA)
+
+    def _connect(self):
+        # forked worker processes and writer threads need their own connection
+        key = (os.getpid(), threading.current_thread().ident)
+        db = self._connections.get(key)
+        if db is None:
+            db = sqlite3.connect(self.dbFile)
+            self._connections[key] = db
+        return db
+
+    def addVersion(self, pageId, version, contentId, lastModifierName, lastModificationDate):
+        self._connect().execute("INSERT INTO versions VALUES (?, ?, ?, ?, ?)",
+                                (pageId, version, contentId, lastModifierName, lastModificationDate))
+
+    def addBody(self, contentId, body):
+        self._connect().execute("INSERT OR REPLACE INTO bodies VALUES (?, ?)", (contentId, body))
+
+    def getBody(self, contentId):
+        row = self._connect().execute("SELECT body FROM bodies WHERE id = ?", (contentId,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def commit(self):
+        self._connect().commit()
+
+    def getVersions(self, pageId):
+        """
+        :return: the old versions of the page, oldest first: (version, lastModifierName, lastModificationDate, body)
+        """
+        versions = []
+        query = "SELECT v.version, v.lastModifierName, v.lastModificationDate, v.contentId, b.body " \
+                "FROM versions v LEFT JOIN bodies b ON b.id = v.contentId WHERE v.pageId = ? ORDER BY v.version"
+        for version, lastModifierName, lastModificationDate, contentId, body in self._connect().execute(query, (pageId,)):
+            if body is None: raise IncompleteData("No Body content (id %s) found for version %d of page %s" % (contentId, version, pageId))
+            versions.append((version, lastModifierName, lastModificationDate, body))
+
+        return versions
+
+    def close(self):
+        db = self._connections.get((os.getpid(), threading.current_thread().ident))
+        if db is not None:
+            db.close()
+        # the connections of other threads are closed when they are collected
+        self._connections = {}
+        if self.temporary and exists(self.dbFile):
+            remove(self.dbFile)
+
+
+class SyncManifest():
+    """
+    Remembers the converted pages for incremental runs.
+
+    page id -> {"name": quoted page name, "date": lastModificationDate, "hash": body hash,
+                "revision": last written revision, "attachments": {file name: lastModificationDate},
+                "attachmentVersions": {attachment id: version}}
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pages = {}
+        if exists(filename):
+            with open(filename, "r") as f:
+                self.pages = json.load(f)
+
+    def get(self, pageId):
+        # json keys are strings
+        return self.pages.get(str(pageId))
+
+    def update(self, pageId, entry):
+        self.pages[str(pageId)] = entry
+
+    def save(self):
+        tmpFilename = self.filename + ".tmp"
+        with open(tmpFilename, "w") as f:
+            json.dump(self.pages, f, indent=1, sort_keys=True)
+        rename(tmpFilename, self.filename)
+
+    @staticmethod
+    def hashBody(body):
+        return hashlib.sha1(body.encode("utf-8")).hexdigest()
 
 
 class MoinMoinWriter():
-    def __init__(self, attachmentFolder, outputFolder):
+    def __init__(self, attachmentFolder, outputFolder, copyMode="copy", manifest=None, historyStore=None, markupCache=None,
+                 profiler=None, progress=None, output=None):
+        """
+        :param copyMode: how the attachments are copied, see copyutil.COPY_MODES
+        :param manifest: a SyncManifest to convert only new and changed pages
+        :param historyStore: a HistoryStore to write the old versions of the pages as revisions
+        :param markupCache: a MarkupCache with already translated bodies
+        :param profiler: a PageProfiler recording the time and output of each page
+        :param progress: a ProgressReporter for the written pages and attachment bytes
+        :param output: where the pages are written, a DirectoryOutput of the outputFolder by default
+        """
         self.attachmentFolder = attachmentFolder
         self.outputFolder = outputFolder
+        self.copyMode = copyMode
+        self.manifest = manifest
+        self.historyStore = historyStore
+        self.markupCache = markupCache
+        self.profiler = profiler
+        self.progress = progress
+        if output is None:
+            output = DirectoryOutput(outputFolder)
+        self.output = output
+        # bytes of all copied attachments
+        self.attachmentBytes = 0
+        # pipelined mode: page id -> {body: markup} translated by the worker processes
+        self._translations = {}
+        self._lock = threading.Lock()
+        # incremental mode: names of the pages left behind by moved or renamed pages
+        self._movedNames = set()
+
+    def syncPage(self, pageId):
+        """
+        Writes the page. In incremental mode an already converted page gets a new revision
+        if it has been changed and is skipped otherwise.
 
-    def writePage(self, pageId):
-        page = Page.all.get(pageId)
-        if page is None:
-            raise BaseException("No page found: " + pageId)
-        content = BodyContent.all.get(page.contentId)
-        if content is None: raise BaseException("No Body content (id %s) found for page %s" % (page.contentId, pageId))
+        :return: the manifest entry of the page or None if nothing has been written
+        """
+        if self.manifest is None:
+            return self.writePage(pageId)
 
-        space = Space.all.get(page.spaceId)
-        if space is None: raise BaseException("No Space %s found for page %s" % (page.spaceId, pageId))
+        page, content = self._getPage(pageId)
+        entry = self.manifest.get(pageId)
+        if entry is None or not self.output.pageExists(entry["name"]):
+            return self.writePage(pageId)
 
-        pageName = self._makeFullPageName(page)
-        pageNamePath = join(self.outputFolder, pageName)
-        if exists(pageNamePath): raise StandardError("Page %s already exists in output folder. Will not overwrite anything." % pageName)
+        if entry["name"] != page.fsName:
+            print("Page %s has been moved or renamed, converting it again as %s." % (pageId, page.fsName))
+            return self.writePage(pageId)
 
-        moinmoinMarkup = StringIO.StringIO()
+        if self._isUnchanged(page, content, entry):
+            return None
+
+        return self.updatePage(pageId, entry)
+
+    def writePage(self, pageId):
+        """
+        :return: the manifest entry of the page
+        """
+        page, content = self._getPage(pageId)
+
+        pageName = page.fsName
+        lastRevision = self._continuedRevision(pageName)
+        if lastRevision is None:
+            self.output.createPage(pageName)
+            lastRevision = 0
         try:
-            parse(content.body, moinmoinMarkup)
-        except Exception as e:
-            print("Markup parsing error for page %s.\nBodyContent: %s" % (pageId, content.body))
+            return self._writeNewPage(page, content, lastRevision)
+        except:
+            self.output.discardPage(pageName)
             raise
 
-        makedirs(pageNamePath)
+    def _writeNewPage(self, page, content, lastRevision=0):
+        """
+        :param lastRevision: the last revision of an existing page folder the page continues
+        :return: the manifest entry of the page
+        """
+        pageName = page.fsName
 
-        self._write(join(pageNamePath, "current"), "00000001")
+        # (lastModificationDate, user id, markup) of all revisions, oldest first
+        revisions = []
+        for version, lastModifierName, lastModificationDate, body in self._getVersions(page):
+            revisions.append((lastModificationDate, MoinMoinUsers.getUserIdForName(lastModifierName), self._translate(page, body)))
+        revisions.append((page.lastModificationDate, page.lastModifierId, self._translate(page, content.body)))
+
+        self.output.writeFile(pageName, "current", "%08d" % (lastRevision + len(revisions)))
         # http://moinmo.in/MoinDev/Storage
 
         editLogData = []
-        editLogData.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-            page.lastModificationDate * 1000000,
-            "00000001",
-            "SAVENEW",
-            pageName,
-            "127.0.0.1",
-            "127.0.0.1",
-            page.lastModifierId,
-            "",  # extra currently unused
-            wikiutil.clean_input(config.COMMENT)
-        ))
+        for number, (lastModificationDate, userId, pageContent) in enumerate(revisions, lastRevision + 1):
+            action = "SAVENEW" if number == 1 else "SAVE"
+            editLogData.append(self._editLogLine(lastModificationDate, "%08d" % number, action, pageName,
+                                                 userId, wikiutil.clean_input(config.COMMENT)))
 
+        attachments = {}
         for attachmentId in page.attachments:
-            line = self._addAttachment(page, pageName, pageNamePath, attachmentId)
+            line = self._addAttachment(page, pageName, attachmentId, attachments)
             if line is not None: editLogData.append(line)
 
-        self._write(join(pageNamePath, "edit-log"), "".join(editLogData))
+        if lastRevision == 0:
+            self.output.writeFile(pageName, "edit-log", "".join(editLogData))
+        else:
+            self.output.appendFile(pageName, "edit-log", "".join(editLogData))
 
-        revisionsPath = join(pageNamePath, "revisions")
-        makedirs(revisionsPath)
+        for number, (lastModificationDate, userId, pageContent) in enumerate(revisions, lastRevision + 1):
+            self.output.writeFile(pageName, join("revisions", "%08d" % number), pageContent)
 
-        pageContent = self._addConvertPrefix(moinmoinMarkup.getvalue())
-        self._write(join(revisionsPath, "00000001"), pageContent)
+        return self._manifestEntry(page, content, lastRevision + len(revisions), attachments)
 
+    def updatePage(self, pageId, entry):
+        """
+        Adds a new revision (if the body has changed) and the new or changed attachments
+        to an already converted page.
 
-    def _addAttachment(self, page, pageName, pageNamePath, attachmentId):
-        attachment = Attachment.all.get(attachmentId)
-        if attachment is None: raise IncompleteData("No attachment found for id %s and page id %s" % (attachmentId, page.id))
-        if attachment.originalVersion is not None:
-            # we only want to have the most recent version
-            return
+        :return: the new manifest entry of the page
+        """
+        page, content = self._getPage(pageId)
+        try:
+            return self._updateExistingPage(page, content, entry)
+        except:
+            self.output.discardPage(page.fsName)
+            raise
 
-        sourceFilePath = join(self.attachmentFolder, page.id, attachmentId, attachment.version)
-        if not exists(sourceFilePath):
-            raise IncompleteData(
-                "Attachment with id %s for page id %s not found. I've expected it here '%s'" % (attachmentId, page.id, sourceFilePath))
+    def _updateExistingPage(self, page, content, entry):
+        """
+        :return: the new manifest entry of the page
+        """
+        pageName = page.fsName
+
+        editLogData = []
+        revision = self._currentRevision(pageName)
+
+        if entry["hash"] != SyncManifest.hashBody(content.body):
+            pageContent = self._translate(page, content.body)
+            revision += 1
+            revisionName = "%08d" % revision
+            self.output.writeFile(pageName, join("revisions", revisionName), pageContent)
+            editLogData.append(self._editLogLine(page.lastModificationDate, revisionName, "SAVE", pageName,
+                                                 page.lastModifierId, wikiutil.clean_input(config.COMMENT)))
+
+        attachments = dict(entry["attachments"])
+        versions = self._attachmentVersions(page)
+        oldVersions = entry.get("attachmentVersions")
+        for attachmentId in page.attachments:
+            known = entry["attachments"]
+            if oldVersions is not None and oldVersions.get(str(attachmentId)) != versions[str(attachmentId)]:
+                # a new version, whatever its date
+                known = None
+            line = self._addAttachment(page, pageName, attachmentId, attachments, known=known)
+            if line is not None: editLogData.append(line)
 
-        attachmentPath = join(pageNamePath, "attachments")
-        if not exists(attachmentPath):
-            makedirs(attachmentPath)
+        self.output.appendFile(pageName, "edit-log", "".join(editLogData))
+        self.output.writeFile(pageName, "current", "%08d" % revision)
 
-        filename = wikiutil.taintfilename(attachment.filename)
-        filename = replace_non_ascii_chars(filename)
-        targetFilePath = join(attachmentPath, filename)
+        return self._manifestEntry(page, content, revision, attachments)
 
-        shutil.copy(sourceFilePath, targetFilePath)
+    def deletePage(self, pageId, entry):
+        """
+        Deletes the page of the manifest entry the way MoinMoin does: "current" points to a
+        new revision without a file and the edit-log gets a SAVE/DELETE entry, the history stays.
+        """
+        page, content = self._getPage(pageId)
+        pageName = entry["name"]
+        try:
+            revision = self._currentRevision(pageName) + 1
+            self.output.appendFile(pageName, "edit-log", self._editLogLine(
+                page.lastModificationDate, "%08d" % revision, "SAVE/DELETE", pageName,
+                page.lastModifierId, wikiutil.clean_input(config.COMMENT)))
+            self.output.writeFile(pageName, "current", "%08d" % revision)
+        except:
+            self.output.discardPage(pageName)
+            raise
 
-        if attachment.lastModificationDate < page.lastModificationDate:
-            attachmentTime = attachment.lastModificationDate
-        else:
-            attachmentTime = page.lastModificationDate
+    def _deleteMovedPages(self, pageIds):
+        """
+        Deletes the pages left behind by moved or renamed pages before anything is written,
+        unless another page takes over the name (e.g. two pages which swapped their titles).
+        The names are kept in _movedNames.
+        """
+        newNames = set([Page.all[pageId].fsName for pageId in pageIds])
+        for pageId in pageIds:
+            entry = self.manifest.get(pageId)
+            if entry is None or entry["name"] == Page.all[pageId].fsName:
+                continue
+            pageName = entry["name"]
+            self._movedNames.add(pageName)
+            if pageName in newNames or not self.output.pageExists(pageName) or self._deletedRevision(pageName) is not None:
+                continue
+            print("Page %s has been moved or renamed, deleting %s." % (pageId, pageName))
+            self.deletePage(pageId, entry)
+            self.output.pageDone(pageName)
+
+    def _continuedRevision(self, pageName):
+        """
+        In incremental mode a new page continues an existing page folder, if the page there
+        has been deleted (like MoinMoin deletes pages) or moved or renamed.
+
+        :return: the last revision of the page folder or None if it can't be continued
+        """
+        if self.manifest is None or not self.output.pageExists(pageName):
+            return None
+        if pageName in self._movedNames:
+            return self._currentRevision(pageName)
+        return self._deletedRevision(pageName)
+
+    def _deletedRevision(self, pageName):
+        """
+        :return: the current revision of the page if it has been deleted (no file for the
+            current revision), None otherwise
+        """
+        revision = self._currentRevision(pageName)
+        try:
+            self.output.readFile(pageName, join("revisions", "%08d" % revision))
+        except IOError:
+            return revision
+        return None
+
+    def _currentRevision(self, pageName):
+        return int(self.output.readFile(pageName, "current").strip())
+
+    def _getPage(self, pageId):
+        """
+        :return: the page and its body content
+        """
+        page = Page.all.get(pageId)
+        if page is None:
+            raise BaseException("No page found: %s" % pageId)
+        content = BodyContent.all.get(page.contentId)
+        if content is None: raise BaseException("No Body content (id %s) found for page %s" % (page.contentId, pageId))
+
+        space = Space.all.get(page.spaceId)
+        if space is None: raise BaseException("No Space %s found for page %s" % (page.spaceId, pageId))
+
+        if page.fsName is None: raise IncompleteData(Page.hierarchyErrors.get(pageId, "Page %s is not in the page tree" % pageId))
+
+        return page, content
+
+    def _getVersions(self, page):
+        if self.historyStore is None:
+            return []
+        return self.historyStore.getVersions(page.id)
+
+    def _translate(self, page, body):
+        """
+        :return: the MoinMoin markup of the body
+        """
+        translations = self._translations.get(page.id)
+        if translations is not None and translations.has_key(body):
+            return self._addConvertPrefix(translations[body])
+        return self._addConvertPrefix(self._translateBody(page, body))
+
+    def _translateBody(self, page, body):
+        """
+        :return: the MoinMoin markup of the body, without the prefix
+        """
+        start = time.time()
+        markup = None
+        if self.markupCache is not None:
+            markup = self.markupCache.get(body)
+
+        if markup is None:
+            moinmoinMarkup = StringIO.StringIO()
+            try:
+                parse(body, moinmoinMarkup)
+            except Exception as e:
+                print("Markup parsing error for page %s.\nBodyContent: %s" % (page.id, body))
+                raise
+
+            markup = moinmoinMarkup.getvalue()
+            if self.markupCache is not None:
+                self.markupCache.put(body, markup)
+
+        if self.profiler is not None:
+            self.profiler.addTranslation(page.id, time.time() - start, len(markup))
+        return markup
+
+    def _translatePage(self, pageId):
+        """
+        Translates the body and the old versions of the page, nothing if the page is unchanged
+        according to the manifest.
 
+        :return: body -> markup
+        """
+        page, content = self._getPage(pageId)
+        if self.manifest is not None:
+            entry = self.manifest.get(pageId)
+            if entry is not None and entry["name"] == page.fsName and self._isUnchanged(page, content, entry):
+                return {}
+
+        translations = {}
+        for version, lastModifierName, lastModificationDate, body in self._getVersions(page):
+            if not translations.has_key(body):
+                translations[body] = self._translateBody(page, body)
+        if not translations.has_key(content.body):
+            translations[content.body] = self._translateBody(page, content.body)
+        return translations
+
+    def _isUnchanged(self, page, content, entry):
+        return entry["date"] == page.lastModificationDate and entry["hash"] == SyncManifest.hashBody(content.body) \
+            and entry.get("attachmentVersions") == self._attachmentVersions(page)
+
+    def _attachmentVersions(self, page):
+        """
+        :return: attachment id -> version of the attachments of the page (the keys are strings like in json)
+        """
+        versions = {}
+        for attachmentId in page.attachments:
+            attachment = Attachment.all.get(attachmentId)
+            versions[str(attachmentId)] = attachment.version if attachment is not None else None
+        return versions
+
+    def _manifestEntry(self, page, content, revision, attachments):
+        return {
+            "name": page.fsName,
+            "date": page.lastModificationDate,
+            "hash": SyncManifest.hashBody(content.body),
+            "revision": revision,
+            "attachments": attachments,
+            "attachmentVersions": self._attachmentVersions(page)
+        }
+
+    def _editLogLine(self, timestamp, revision, action, pageName, userId, extra):
         # 1407004115054438        99999999        ATTNEW  attTest 192.168.56.1    192.168.56.1    1406319234.36.47302     1.txt
         return "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-            attachmentTime * 1000000,
-            "99999999",
-            "ATTNEW",
+            timestamp * 1000000,
+            revision,
+            action,
             pageName,
             "127.0.0.1",
             "127.0.0.1",
-            attachment.creatorNameId,
+            userId,
             "",  # extra currently unused
-            urllib.quote(print_safe(filename))
+            extra
         )
 
-    def _addConvertPrefix(self, text):
-        return config.PAGE_PREFIX + text
+    def _addAttachment(self, page, pageName, attachmentId, attachments, known=None):
+        """
+        Copies the attachment and adds it to 'attachments' (file name -> lastModificationDate).
 
+        :param known: attachments already copied by an earlier run, they are copied again only if they have changed
+        :return: the edit-log line or None
+        """
+        attachment = Attachment.all.get(attachmentId)
+        if attachment is None: raise IncompleteData("No attachment found for id %s and page id %s" % (attachmentId, page.id))
 
-    def _write(self, filename, content):
-        # encoding='utf-8'
-        # with open(filename, "w") as file:
-        # file.write(content)
-        with codecs.open(filename, 'w', encoding='utf-8') as f:
-            f.write(content)
+        filename = wikiutil.taintfilename(attachment.filename)
+        filename = replace_non_ascii_chars(filename)
+        if known is not None and known.get(filename, -1) >= attachment.lastModificationDate:
+            return
 
-    def _makeFullPageName(self, page):
-        path = ""
-        currentPage = page
-        while True:
-            path = currentPage.title + "/" + path
-            if currentPage.parentId is None:
-                break
+        sourceFilePath = join(self.attachmentFolder, str(page.id), str(attachmentId), str(attachment.version))
+        if not exists(sourceFilePath):
+            raise IncompleteData(
+                "Attachment with id %s for page id %s not found. I've expected it here '%s'" % (attachmentId, page.id, sourceFilePath))
 
-            nextPage = Page.all.get(currentPage.parentId)
-            if nextPage is None: raise StandardError("No parent page %s found for page %s" % (currentPage.parentId, currentPage.id))
-            currentPage = nextPage
+        size = self.output.copyFile(pageName, join("attachments", filename), sourceFilePath, self.copyMode)
+        with self._lock:
+            self.attachmentBytes += size
+        if self.profiler is not None:
+            self.profiler.addAttachment(page.id, size)
+        attachments[filename] = attachment.lastModificationDate
+
+        if attachment.lastModificationDate < page.lastModificationDate:
+            attachmentTime = attachment.lastModificationDate
+        else:
+            attachmentTime = page.lastModificationDate
 
-        # remove last /
-        path = path[0:-1]
+        return self._editLogLine(attachmentTime, "99999999", "ATTNEW", pageName, attachment.creatorNameId,
+                                 urllib.quote(print_safe(filename)))
 
-        return wikiutil.quoteWikinameFS(path)
+    def _addConvertPrefix(self, text):
+        return config.PAGE_PREFIX + text
+
+    def writePageForSpaces(self, spaceKeys, jobs=1, writeThreads=0, queueSize=100):
+        """
+        Writes all pages of the given spaces. With more than one job the pages are
+        written by a pool of processes and all errors are reported at the end.
 
-    def writePageForSpaces(self, spaceKeys):
+        :param writeThreads: pipelined mode if > 0: the pages are translated by 'jobs' processes
+            and written by this number of threads at the same time
+        :param queueSize: the maximum number of pages in the pipeline (translated, not yet written)
+        """
         # find space ids
         validSpaceIds = {}
         for key in spaceKeys:
             id = Space.getSpaceByKey(key).id
             validSpaceIds[id] = True
 
-        for page in Page.all.values():
-            if not validSpaceIds.has_key(page.spaceId):
-                continue
+        pageIds = [page.id for page in Page.all.values() if validSpaceIds.has_key(page.spaceId)]
 
-            self.writePage(page.id)
+        # fail before anything is written
+        errors = [Page.hierarchyErrors[pageId] for pageId in pageIds if Page.hierarchyErrors.has_key(pageId)]
+        if errors:
+            raise IncompleteData("Broken page tree:\n" + "\n".join(sorted(errors)))
 
+        if self.progress is not None:
+            self.progress.startPhase("write", total=len(pageIds))
 
-class MoinMoinUsers():
-    USER_FILE_RE = re.compile(r'^[0-9\.]+$')
+        try:
+            if self.manifest is not None:
+                self._deleteMovedPages(pageIds)
+            if writeThreads > 0:
+                self._writePagesPipelined(pageIds, jobs, writeThreads, queueSize)
+            elif jobs <= 1:
+                written = 0
+                for done, pageId in enumerate(pageIds, 1):
+                    entry = self._syncProfiledPage(pageId)
+                    if entry is not None:
+                        self._pageSynced(pageId, entry)
+                        written += 1
+                    self._reportProgress(done, written, 0)
+                if self.manifest is not None:
+                    print("%d pages written, %d unchanged." % (written, len(pageIds) - written))
+            else:
+                self._writePagesInPool(pageIds, jobs)
+        finally:
+            # publishes the completely written pages
+            self.output.close()
+            if self.manifest is not None:
+                self.manifest.save()
+
+        if self.progress is not None:
+            self.progress.finishPhase()
+
+    def _reportProgress(self, done, written, failed):
+        if self.progress is not None:
+            self.progress.update(done=done, pages=written, failedPages=failed, attachmentBytes=self.attachmentBytes)
+
+    def _syncProfiledPage(self, pageId):
+        if self.profiler is None:
+            return self.syncPage(pageId)
+        return self.profiler.runPage(pageId, self.syncPage)
+
+    def _pageSynced(self, pageId, entry):
+        self.output.pageDone(entry["name"])
+        if self.manifest is not None:
+            self.manifest.update(pageId, entry)
+
+    def _writePagesInPool(self, pageIds, jobs):
+        global _workerWriter
+        # the forked worker processes inherit the writer and the loaded model
+        _workerWriter = self
+        pool = multiprocessing.Pool(jobs)
+        written = 0
+        errors = []
+        try:
+            for done, (pageId, entry, error, attachmentBytes, pageProfile) in enumerate(
+                    pool.imap_unordered(_writePageInWorker, pageIds), 1):
+                self.attachmentBytes += attachmentBytes
+                if pageProfile is not None:
+                    self.profiler.add(pageId, pageProfile)
+                if error is not None:
+                    errors.append((pageId, error))
+                elif entry is not None:
+                    self._pageSynced(pageId, entry)
+                    written += 1
+                self._reportProgress(done, written, len(errors))
+        finally:
+            pool.close()
+            pool.join()
+            _workerWriter = None
+
+        self._reportErrors(len(pageIds), written, errors)
+
+    def _writePagesPipelined(self, pageIds, jobs, writeThreads, queueSize):
+        """
+        Translation (worker processes) and writing (threads) overlap: while a page waits for
+        its attachments to be copied, the next pages are translated. At most 'queueSize'
+        pages are between the two stages.
+        """
+        global _workerWriter
+        _workerWriter = self
+        slots = threading.Semaphore(queueSize)
+        stopped = threading.Event()
+        writeQueue = Queue.Queue()
+        results = Queue.Queue()
+
+        def feed():
+            # runs in the task thread of the pool, blocks while the pipeline is full
+            for pageId in pageIds:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield pageId
+
+        def write():
+            while True:
+                pageId = writeQueue.get()
+                if pageId is None:
+                    return
+                try:
+                    entry, error = self._syncProfiledPage(pageId), None
+                except Exception:
+                    entry, error = None, traceback.format_exc()
+                self._translations.pop(pageId, None)
+                slots.release()
+                results.put((pageId, entry, error))
+
+
+        state = {"done": 0, "written": 0}
+        errors = []
+
+        def collect(block):
+            while True:
+                try:
+                    pageId, entry, error = results.get(block)
+                except Queue.Empty:
+                    return
+                state["done"] += 1
+                if error is not None:
+                    errors.append((pageId, error))
+                elif entry is not None:
+                    self._pageSynced(pageId, entry)
+                    state["written"] += 1
+                self._reportProgress(state["done"], state["written"], len(errors))
+                if block:
+                    return
+
+        # forked before the writer threads are started
+        pool = multiprocessing.Pool(jobs)
+        threads = [threading.Thread(target=write, name="writer-%d" % number) for number in range(writeThreads)]
+        for writerThread in threads:
+            writerThread.daemon = True
+            writerThread.start()
+        queued = 0
+        finished = False
+        try:
+            for pageId, translations, error, pageProfile in pool.imap_unordered(_translatePageInWorker, feed()):
+                if pageProfile is not None:
+                    self.profiler.add(pageId, pageProfile)
+                if error is not None:
+                    slots.release()
+                    results.put((pageId, None, error))
+                else:
+                    self._translations[pageId] = translations
+                    writeQueue.put(pageId)
+                queued += 1
+                # the output is only touched by the main thread besides the writers
+                collect(False)
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                # the task thread of the pool may wait for a free slot, nobody frees one anymore
+                stopped.set()
+                slots.release()
+                pool.terminate()
+                # the writers finish their current page only
+                while True:
+                    try:
+                        writeQueue.get_nowait()
+                    except Queue.Empty:
+                        break
+            pool.join()
+            for writerThread in threads:
+                writeQueue.put(None)
+            if finished:
+                while state["done"] < queued:
+                    collect(True)
+            for writerThread in threads:
+                writerThread.join()
+            _workerWriter = None
+
+        self._reportErrors(len(pageIds), state["written"], errors)
+
+    def _reportErrors(self, pageCount, written, errors):
+        print("%d pages written, %d unchanged, %d failed." % (written, pageCount - written - len(errors), len(errors)))
+        for pageId, error in errors:
+            print("Page %s failed:\n%s" % (pageId, error))
+        if errors:
+            raise StandardError("%d pages could not be converted." % len(errors))
+
+
+# the writer of the current writePageForSpaces call, used by the worker processes
+_workerWriter = None
+
+
+def _writePageInWorker(pageId):
+    """
+    :return: the page id, the manifest entry (or None), None or the formatted exception,
+        the bytes of the copied attachments and the profile record of the page (or None)
+    """
+    attachmentBytes = _workerWriter.attachmentBytes
+    try:
+        entry, error = _workerWriter._syncProfiledPage(pageId), None
+    except Exception:
+        entry, error = None, traceback.format_exc()
+    attachmentBytes = _workerWriter.attachmentBytes - attachmentBytes
+
+    if _workerWriter.profiler is None:
+        return pageId, entry, error, attachmentBytes, None
+    return pageId, entry, error, attachmentBytes, _workerWriter.profiler.take(pageId)
+
+
+def _translatePageInWorker(pageId):
+    """
+    :return: the page id, body -> markup, None or the formatted exception and the profile
+        record of the page (or None)
+    """
+    try:
+        translations, error = _workerWriter._translatePage(pageId), None
+    except Exception:
+        translations, error = None, traceback.format_exc()
+
+    if _workerWriter.profiler is None:
+        return pageId, translations, error, None
+    return pageId, translations, error, _workerWriter.profiler.take(pageId)
 
+
+class MoinMoinUsers():
     # name -> id (= filename)
     all = {}
     defaultUserId = None
 
-    def __init__(self, folder):
+    def __init__(self, folder, users=None):
+        """
+        :param users: name -> id of the users just converted, the folder isn't read then
+        """
         self.folder = folder
-        self._readUserFromFolder()
+        if users is None:
+            self._readUserFromFolder()
+        else:
+            MoinMoinUsers.all = users
 
         if MoinMoinUsers.all.has_key(config.DEFAULT_USER) is False:
             raise RuntimeError("no default user (%s) found." % config.DEFAULT_USER)
@@ -377,53 +1434,138 @@ class MoinMoinUsers():
 
 
     def _readUserFromFolder(self):
-        MoinMoinUsers.all = {}
-        for file in listdir(self.folder):
-            if MoinMoinUsers.USER_FILE_RE.match(file) is None: continue
-            name = self._getNameFromUserFile(join(self.folder, file))
-            MoinMoinUsers.all[name] = file
-
-
-    def _getNameFromUserFile(self, file):
-        lookingFor = "name="
-        with open(file, "r") as file:
-            for line in file:
-                if line.startswith(lookingFor):
-                    # remove the newline also
-                    return line[len(lookingFor):len(line) - 1]
-
-        raise BaseException("No name= entry found!")
+        # from the index file, the user files are only read if it is outdated
+        MoinMoinUsers.all = userindex.loadUsers(self.folder)
+
+
+def createArgumentParser(description='Convert pages'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--xmlInputFile', type=str, help='The crowd backup file (xml)')
+    parser.add_argument('--attachmentPath', type=str, help='The path to the folder containing the confluence attachments.')
+    parser.add_argument('--convertedUserPath', type=str, help='The path to the folder containing the converted users.')
+    parser.add_argument('--outputPath', type=str, help='The output path. The pages will be created here.')
+    parser.add_argument('--onlyConfiguredSpaces', action='store_true', help='Only load the pages, bodies and attachments of the spaces in config.SPACES.')
+    parser.add_argument('--modelStore', type=str, help='SQLite database with the extracted model. Written if --xmlInputFile is given, read otherwise.')
+    parser.add_argument('--ingestOnly', action='store_true', help='Only parse the xml file into the --modelStore database, don\'t convert anything.')
+    parser.add_argument('--attachmentCopyMode', choices=copyutil.COPY_MODES, default="copy",
+                        help='How the attachments are copied. "hardlink" shares the files with the export, "reflink" clones them on btrfs/XFS and "kernel" copies inside the kernel.')
+    parser.add_argument('--syncManifest', type=str, help='Incremental mode: only new or changed pages are converted, changed pages get a new revision. The converted pages are remembered in this file.')
+    parser.add_argument('--history', action='store_true', help='Convert all old versions of the pages as revisions. Needs --xmlInputFile.')
+    parser.add_argument('--historySpool', type=str, help='SQLite file the old versions are spooled to while parsing (default: a temporary file).')
+    parser.add_argument('--markupCache', type=str, help='Folder of a cache with the translated markup of the page bodies.')
+    parser.add_argument('--markupCacheSize', type=int, default=1024, help='The maximum size of the markup cache in MB.')
+    parser.add_argument('--stagedOutput', action='store_true', help='Build the pages in a staging folder and publish them in batches, a running wiki never sees a partial page.')
+    parser.add_argument('--stagingPath', type=str, help='The staging folder for --stagedOutput, on the same file system as --outputPath (default: --outputPath + ".staging").')
+    parser.add_argument('--batchSize', type=int, default=100, help='The number of pages published at once with --stagedOutput.')
+    parser.add_argument('--outputArchive', type=str, help='Write the pages into this archive (.tar, .tar.gz, .tgz, .tar.bz2 or .zip) instead of --outputPath.')
+    parser.add_argument('--jobs', type=int, default=1, help='The number of processes converting the pages.')
+    parser.add_argument('--pipeline', action='store_true', help='Translate the pages with --jobs processes while --writeThreads threads write the translated pages and copy the attachments.')
+    parser.add_argument('--writeThreads', type=int, default=2, help='The number of threads writing the pages with --pipeline.')
+    parser.add_argument('--queueSize', type=int, default=100, help='The maximum number of pages between translation and writing with --pipeline.')
+    parser.add_argument('--progressInterval', type=int, default=10, help='Seconds between two progress reports, 0 to switch them off.')
+    parser.add_argument('--progressJson', type=str, help='Append the progress reports as json lines to this file.')
+    parser.add_argument('--progressPrometheus', type=str, help='Write the progress as Prometheus metrics to this file (textfile collector).')
+    parser.add_argument('--profile', type=str, help='Write a report with the time of each stage and the slowest pages to this file.')
+    parser.add_argument('--profileTop', type=int, default=20, help='The number of slowest pages in the --profile report.')
+    parser.add_argument('--profilePage', type=int, help='Run the conversion of the page with this id within cProfile, the stats are added to the --profile report.')
+    return parser
+
+
+def checkArguments(parser, args):
+    if args.xmlInputFile is None and args.modelStore is None:
+        parser.error("--xmlInputFile or --modelStore is required")
+    if args.ingestOnly:
+        if args.xmlInputFile is None or args.modelStore is None:
+            parser.error("--ingestOnly needs --xmlInputFile and --modelStore")
+    elif args.attachmentPath is None or args.convertedUserPath is None or (args.outputPath is None and args.outputArchive is None):
+        parser.error("--attachmentPath, --convertedUserPath and --outputPath (or --outputArchive) are required")
+    if args.outputArchive is not None:
+        if args.outputPath is not None or args.stagedOutput or args.syncManifest is not None:
+            parser.error("--outputArchive can't be used with --outputPath, --stagedOutput or --syncManifest")
+        if args.pipeline:
+            if args.writeThreads > 1:
+                parser.error("--outputArchive is written by one thread, it can't be used with --writeThreads")
+        elif args.jobs > 1:
+            parser.error("--outputArchive is written by one process, it can't be used with --jobs (but with --pipeline)")
+        if ArchiveOutput.guessFormat(args.outputArchive) is None:
+            parser.error("--outputArchive must end with one of: " + ", ".join(suffix for suffix, format in ArchiveOutput.FORMATS))
+    if args.history and (args.xmlInputFile is None or args.ingestOnly):
+        parser.error("--history needs --xmlInputFile and can't be used with --ingestOnly")
+    if args.profilePage is not None and args.profile is None:
+        parser.error("--profilePage needs --profile")
+    if args.pipeline and (args.writeThreads < 1 or args.queueSize < 1):
+        parser.error("--writeThreads and --queueSize must be at least 1")
+    if args.pipeline and args.profilePage is not None:
+        parser.error("--profilePage can't be used with --pipeline, the page is translated in a worker process")
+
+
+def convert(args, users=None, timer=None):
+    """
+    :param users: name -> id of the converted users, read from --convertedUserPath if None
+    :param timer: StageTimer with the stages run before (e.g. the user conversion)
+    """
+    if timer is None:
+        timer = StageTimer()
+    if args.progressInterval > 0:
+        progress = ProgressReporter(interval=args.progressInterval, jsonFile=args.progressJson,
+                                    prometheusFile=args.progressPrometheus)
+    else:
+        progress = None
 
+    if not args.ingestOnly:
+        MoinMoinUsers(args.convertedUserPath, users)
 
-if __name__ == '__main__':
+    if args.onlyConfiguredSpaces:
+        spaceKeys = config.SPACES.keys()
+    else:
+        spaceKeys = None
 
-    parser = argparse.ArgumentParser(description='Convert pages')
-    parser.add_argument('--xmlInputFile', type=str, required=True, help='The crowd backup file (xml)')
-    parser.add_argument('--attachmentPath', type=str, required=True, help='The path to the folder containing the confluence attachments.')
-    parser.add_argument('--convertedUserPath', type=str, required=True, help='The path to the folder containing the converted users.')
-    parser.add_argument('--outputPath', type=str, required=True, help='The output path. The pages will be created here.')
-    args = parser.parse_args()
+    if args.history:
+        historyStore = HistoryStore(args.historySpool)
+    else:
+        historyStore = None
+
+    if args.xmlInputFile is not None:
+        print("loading & parse xml file...")
+        loader = EntitiesLoader(spaceKeys=spaceKeys, historyStore=historyStore, progress=progress)
+        with timer.stage("load"):
+            loader.load(args.xmlInputFile)
+        print("%d objects parsed, %d dropped." % (loader.objectCount, loader.droppedCount))
+
+        if args.modelStore is not None:
+            print("writing model store...")
+            with timer.stage("store"):
+                store = ModelStore(args.modelStore)
+                store.save()
+                store.close()
+    else:
+        print("loading model store...")
+        with timer.stage("load"):
+            store = ModelStore(args.modelStore)
+            store.load(spaceKeys=spaceKeys)
+            store.close()
+        print("%d pages loaded." % len(Page.all))
+
+    if args.profile is not None:
+        if args.profilePage is not None:
+            profiler = PageProfiler(args.profilePage, args.profile + ".page-%s.prof" % args.profilePage)
+        else:
+            profiler = PageProfiler()
+    else:
+        profiler = None
 
-    MoinMoinUsers(args.convertedUserPath)
+    if args.ingestOnly:
+        if profiler is not None:
+            writeReport(args.profile, timer.stages, profiler, Page.all, args.profileTop)
+        print("Finished.")
+        return
 
-    print("loading & parse xml file...")
-    tree = ET.parse(args.xmlInputFile)
     print("create MoinMoin pages & attachments...")
 
-    for obj in tree.findall("./object"):
-        className = obj.attrib["class"]
-
-        if className == "Space":
-            Space(obj)
-        elif className == "Page":
-            Page(obj)
-        elif className == "Attachment":
-            Attachment(obj)
-        elif className == "BodyContent":
-            BodyContent(obj)
-
-    Space.renameSpaces(config.SPACES)
-    Page.renameHomePages()
+    with timer.stage("model"):
+        Space.renameSpaces(config.SPACES)
+        Page.renameHomePages()
+        Page.buildHierarchy()
 
     # debug
 
@@ -448,7 +1590,46 @@ if __name__ == '__main__':
     # print(att)
 
 
-    writer = MoinMoinWriter(attachmentFolder=args.attachmentPath, outputFolder=args.outputPath)
-    writer.writePageForSpaces(config.SPACES.values())
+    if args.syncManifest is not None:
+        manifest = SyncManifest(args.syncManifest)
+    else:
+        manifest = None
 
-    print("Finished.")
\ No newline at end of file
+    if args.markupCache is not None:
+        markupCache = MarkupCache(args.markupCache, maxBytes=args.markupCacheSize * 1024 * 1024)
+    else:
+        markupCache = None
+
+    if args.outputArchive is not None:
+        output = ArchiveOutput(args.outputArchive)
+    elif args.stagedOutput:
+        output = StagedOutput(args.outputPath, stagingFolder=args.stagingPath, batchSize=args.batchSize)
+    else:
+        output = DirectoryOutput(args.outputPath)
+
+    writer = MoinMoinWriter(attachmentFolder=args.attachmentPath, outputFolder=args.outputPath,
+                            copyMode=args.attachmentCopyMode, manifest=manifest, historyStore=historyStore,
+                            markupCache=markupCache, profiler=profiler, progress=progress, output=output)
+    try:
+        with timer.stage("write"):
+            if args.pipeline:
+                writer.writePageForSpaces(config.SPACES.values(), jobs=args.jobs, writeThreads=args.writeThreads,
+                                          queueSize=args.queueSize)
+            else:
+                writer.writePageForSpaces(config.SPACES.values(), jobs=args.jobs)
+    finally:
+        if historyStore is not None:
+            historyStore.close()
+        if profiler is not None:
+            writeReport(args.profile, timer.stages, profiler, Page.all, args.profileTop)
+            print("Profile written to %s." % args.profile)
+
+    print("Finished.")
+
+
+if __name__ == '__main__':
+
+    parser = createArgumentParser()
+    args = parser.parse_args()
+    checkArguments(parser, args)
+    convert(args)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+File copy strategies for the attachments.
+
+ * copy: plain copy through user space (like shutil.copy)
+ * hardlink: link the target to the source file, falls back to copy across file systems
+ * reflink: copy-on-write clone (btrfs, XFS, ...), falls back to kernel
+ * kernel: copy inside the kernel with copy_file_range or sendfile, falls back to copy
+"""
+
+import os
+import errno
+import shutil
+import ctypes
+import ctypes.util
+
+COPY_MODES = ("copy", "hardlink", "reflink", "kernel")
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning "not possible for these files", so the next strategy is tried
+FALLBACK_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EPERM,
+                   errno.EBADF, errno.ETXTBSY)
+# errors meaning "not supported at all", the strategy isn't tried again. The others (e.g.
+# EXDEV for files on different file systems) only depend on the files.
+UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP)
+
+_CHUNK_SIZE = 1 << 30
+
+_libc = None
+# disabled after the first UNSUPPORTED_ERRORS error, so we don't fail on every file
+_supported = {"reflink": True, "copy_file_range": True, "sendfile": True}
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+def copyFile(source, target, mode="copy"):
+    """
+    Copies the file 'source' to the file path 'target' (including the permission bits).
+
+    :param mode: one of COPY_MODES
+    :return: the number of bytes of the file
+    """
+    if mode == "hardlink":
+        try:
+            os.link(source, target)
+            return os.path.getsize(target)
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+        mode = "copy"
+
+    if mode == "reflink":
+        if _supported["reflink"] and _reflink(source, target):
+            return os.path.getsize(target)
+        mode = "kernel"
+
+    if mode == "kernel":
+        size = _kernelCopy(source, target)
+        if size is not None:
+            return size
+        mode = "copy"
+
+    if mode != "copy":
+        raise ValueError("Unknown copy mode %s" % mode)
+
+    shutil.copy(source, target)
+    return os.path.getsize(target)
+
+
+def _reflink(source, target):
+    """
+    :return: True if the target has been cloned
+    """
+    import fcntl
+
+    with open(source, "rb") as src:
+        with open(target, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except IOError as e:
+                if e.errno not in FALLBACK_ERRORS:
+                    raise
+                if e.errno in UNSUPPORTED_ERRORS:
+                    _supported["reflink"] = False
+                return False
+    shutil.copymode(source, target)
+    return True
+
+
+def _kernelCopy(source, target):
+    """
+    :return: the number of bytes copied or None if the kernel can't copy these files
+    """
+    with open(source, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        with open(target, "wb") as dst:
+            for name, copyChunk in (("copy_file_range", _copyFileRange), ("sendfile", _sendfile)):
+                if not _supported[name]:
+                    continue
+                try:
+                    copied = 0
+                    while copied < size:
+                        count = copyChunk(src.fileno(), dst.fileno(), min(size - copied, _CHUNK_SIZE))
+                        if count == 0:
+                            break
+                        copied += count
+                except OSError as e:
+                    # nothing has been copied yet if the call isn't supported
+                    if e.errno not in FALLBACK_ERRORS or copied > 0:
+                        raise
+                    if e.errno in UNSUPPORTED_ERRORS:
+                        _supported[name] = False
+                    continue
+
+                shutil.copymode(source, target)
+                return copied
+
+    return None
+
+
+def _copyFileRange(fdIn, fdOut, count):
+    if hasattr(os, "copy_file_range"):
+        return os.copy_file_range(fdIn, fdOut, count)
+
+    libc = _getLibc()
+    if not hasattr(libc, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    libc.copy_file_range.restype = ctypes.c_ssize_t
+    result = libc.copy_file_range(fdIn, None, fdOut, None, ctypes.c_size_t(count), 0)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def _sendfile(fdIn, fdOut, count):
+    if hasattr(os, "sendfile"):
+        return os.sendfile(fdOut, fdIn, None, count)
+
+    libc = _getLibc()
+    libc.sendfile.restype = ctypes.c_ssize_t
+    result = libc.sendfile(fdOut, fdIn, None, ctypes.c_size_t(count))
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generates a synthetic Confluence export (entities.xml, the attachment tree and converted
+users) to test and benchmark the conversion at any scale.
+
+The first spaces get the keys of config.SPACES, so the export can be converted right away.
+"""
+
+import argparse
+import os
+from os import makedirs
+from os.path import join, exists
+import random
+import time
+
+import config
+
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consetetur", "sadipscing", "elitr", "sed", "diam",
+         "nonumy", "eirmod", "tempor", "invidunt", "ut", "labore", "et", "dolore", "magna", "aliquyam")
+
+MACROS = (
+    '<ac:macro ac:name="info"><ac:rich-text-body><p>%s</p></ac:rich-text-body></ac:macro>',
+    '<ac:macro ac:name="note"><ac:parameter ac:name="title">Note</ac:parameter><ac:rich-text-body><p>%s</p></ac:rich-text-body></ac:macro>',
+    '<ac:macro ac:name="code"><ac:plain-text-body>%s</ac:plain-text-body></ac:macro>',
+    '<ac:macro ac:name="status"><ac:parameter ac:name="colour">Green</ac:parameter><ac:parameter ac:name="title">%s</ac:parameter></ac:macro>',
+    '<p><ac:macro ac:name="anchor"><ac:default-parameter>%s</ac:default-parameter></ac:macro></p>',
+    '<ac:macro ac:name="toc" /><!-- %s -->',
+)
+
+USERS = ("admin", "editor", "author")
+
+
+class ExportGenerator():
+    """
+    Writes the objects one after the other, so exports larger than the memory can be generated.
+    """
+
+    def __init__(self, outputPath, spaces, pages, depth, bodySize, tables, tableRows, tableColumns, macros,
+                 attachments, attachmentSize, versions, seed=1):
+        """
+        :param pages: the number of pages per space (including the home page)
+        :param depth: the maximum depth of the page tree below the home page
+        :param bodySize: the approximate number of bytes of text per page body
+        :param tables: the number of tables per page
+        :param macros: the number of macros per page
+        :param attachments: the number of attachments per page
+        :param versions: the number of old versions per page and attachment
+        """
+        self.outputPath = outputPath
+        self.spaces = spaces
+        self.pages = pages
+        self.depth = depth
+        self.bodySize = bodySize
+        self.tables = tables
+        self.tableRows = tableRows
+        self.tableColumns = tableColumns
+        self.macros = macros
+        self.attachments = attachments
+        self.attachmentSize = attachmentSize
+        self.versions = versions
+        self.random = random.Random(seed)
+
+        self._nextId = 1000
+        self._attachmentData = "".join(chr(self.random.randint(0, 255)) for i in range(4096))
+        self.counts = {"spaces": 0, "pages": 0, "versions": 0, "attachments": 0, "attachmentBytes": 0}
+
+    def generate(self):
+        """
+        :return: the number of generated objects per kind
+        """
+        if exists(join(self.outputPath, "entities.xml")):
+            raise StandardError("There is already an export in %s. Will not overwrite anything." % self.outputPath)
+
+        for folder in ("attachments", "users"):
+            if not exists(join(self.outputPath, folder)):
+                makedirs(join(self.outputPath, folder))
+
+        self._writeUsers()
+        with open(join(self.outputPath, "entities.xml"), "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<hibernate-generic datetime="%s">\n' % time.strftime("%Y-%m-%d %H:%M:%S"))
+            for spaceKey in self._spaceKeys():
+                self._writeSpace(f, spaceKey)
+            f.write('</hibernate-generic>\n')
+
+        self.counts["xmlBytes"] = os.path.getsize(join(self.outputPath, "entities.xml"))
+        return self.counts
+
+    def _spaceKeys(self):
+        keys = sorted(config.SPACES.keys())
+        for number in range(len(keys), self.spaces):
+            keys.append("space%d" % number)
+        return keys[:self.spaces]
+
+    def _newId(self):
+        self._nextId += 1
+        return str(self._nextId)
+
+    def _writeUsers(self):
+        for number, name in enumerate((config.DEFAULT_USER,) + USERS, 1):
+            with open(join(self.outputPath, "users", "1406058695.752081.%d" % number), "w") as f:
+                f.write("name=%s\n" % name)
+
+    def _writeSpace(self, f, spaceKey):
+        spaceId = self._newId()
+        f.write('<object class="Space" package="com.atlassian.confluence.spaces"><id name="id">%s</id>\n' % spaceId)
+        f.write(self._prop("name", "Space %s" % spaceKey) + self._prop("key", spaceKey) + '</object>\n')
+        self.counts["spaces"] += 1
+
+        # (page id, depth) of the pages, which may get children
+        parents = []
+        for number in range(self.pages):
+            if number == 0:
+                parentId, pageDepth, title = None, 0, "Home"
+            else:
+                parentId, parentDepth = self.random.choice(parents)
+                pageDepth, title = parentDepth + 1, "Page %d" % number
+
+            pageId = self._writePage(f, spaceId, parentId, title)
+            if pageDepth < self.depth:
+                parents.append((pageId, pageDepth))
+
+    def _writePage(self, f, spaceId, parentId, title):
+        pageId = self._newId()
+        contentId = self._newId()
+        modificationDate = self._date(self.versions + 1)
+
+        attachments = []
+        for number in range(self.attachments):
+            attachments.append((self._newId(), "file %d.bin" % number))
+
+        page = ['<object class="Page" package="com.atlassian.confluence.pages"><id name="id">%s</id>\n' % pageId,
+                self._prop("title", title),
+                self._collection("bodyContents", "BodyContent", [contentId]),
+                self._collection("attachments", "Attachment", [attachmentId for attachmentId, filename in attachments]),
+                self._prop("lastModifierName", self.random.choice(USERS)),
+                '<property name="lastModificationDate">%s</property>\n' % modificationDate,
+                self._prop("contentStatus", "current"),
+                '<property name="version">%d</property>\n' % (self.versions + 1),
+                self._ref("space", "Space", spaceId)]
+        if parentId is not None:
+            page.append(self._ref("parent", "Page", parentId))
+        page.append('</object>\n')
+        f.write("".join(page))
+        self._writeBody(f, contentId, pageId, self._makeBody())
+        self.counts["pages"] += 1
+
+        for version in range(1, self.versions + 1):
+            self._writeOldVersion(f, pageId, title, version)
+
+        for attachmentId, filename in attachments:
+            self._writeAttachment(f, pageId, attachmentId, filename, self.versions + 1, None)
+            for version in range(1, self.versions + 1):
+                self._writeAttachment(f, pageId, self._newId(), filename, version, attachmentId)
+
+        return pageId
+
+    def _writeOldVersion(self, f, pageId, title, version):
+        versionId = self._newId()
+        contentId = self._newId()
+        f.write("".join([
+            '<object class="Page" package="com.atlassian.confluence.pages"><id name="id">%s</id>\n' % versionId,
+            self._prop("title", title),
+            self._collection("bodyContents", "BodyContent", [contentId]),
+            self._prop("lastModifierName", self.random.choice(USERS)),
+            '<property name="lastModificationDate">%s</property>\n' % self._date(version),
+            self._prop("contentStatus", "current"),
+            '<property name="version">%d</property>\n' % version,
+            self._ref("originalVersion", "Page", pageId),
+            '</object>\n']))
+        self._writeBody(f, contentId, versionId, self._makeBody())
+        self.counts["versions"] += 1
+
+    def _writeBody(self, f, contentId, pageId, body):
+        f.write('<object class="BodyContent" package="com.atlassian.confluence.core"><id name="id">%s</id>\n' % contentId)
+        f.write(self._prop("body", body) + self._ref("content", "Page", pageId) + '</object>\n')
+
+    def _writeAttachment(self, f, pageId, attachmentId, filename, version, originalId):
+        attachment = ['<object class="Attachment" package="com.atlassian.confluence.pages"><id name="id">%s</id>\n' % attachmentId,
+                      self._prop("fileName", filename),
+                      self._prop("creatorName", self.random.choice(USERS)),
+                      '<property name="attachmentVersion">%d</property>\n' % version,
+                      '<property name="lastModificationDate">%s</property>\n' % self._date(version),
+                      self._ref("content", "Page", pageId)]
+        if originalId is not None:
+            attachment.append(self._ref("originalVersion", "Attachment", originalId))
+        attachment.append('</object>\n')
+        f.write("".join(attachment))
+
+        folder = join(self.outputPath, "attachments", pageId, attachmentId)
+        makedirs(folder)
+        with open(join(folder, str(version)), "wb") as data:
+            remaining = self.attachmentSize
+            while remaining > 0:
+                data.write(self._attachmentData[:remaining])
+                remaining -= len(self._attachmentData)
+        self.counts["attachments"] += 1
+        self.counts["attachmentBytes"] += self.attachmentSize
+
+    def _makeBody(self):
+        parts = []
+        # spread the text, tables and macros over the body
+        blocks = max(1, self.tables + self.macros)
+        textSize = self.bodySize / blocks
+        for number in range(blocks):
+            parts.append("<h2>Section %d</h2>" % number)
+            parts.append(self._makeText(textSize))
+            if number < self.tables:
+                parts.append(self._makeTable())
+            if number < self.macros:
+                parts.append(MACROS[number % len(MACROS)] % self._words(3))
+        return "".join(parts)
+
+    def _makeText(self, size):
+        paragraphs = []
+        length = 0
+        while length < size:
+            paragraph = "<p>%s <strong>%s</strong> %s <em>%s</em></p>" % (
+                self._words(12), self._words(2), self._words(10), self._words(3))
+            paragraphs.append(paragraph)
+            length += len(paragraph)
+        return "".join(paragraphs)
+
+    def _makeTable(self):
+        rows = ["<tr>%s</tr>" % "".join("<th>%s</th>" % self._words(1) for column in range(self.tableColumns))]
+        for row in range(self.tableRows):
+            rows.append("<tr>%s</tr>" % "".join("<td><p>%s</p></td>" % self._words(3) for column in range(self.tableColumns)))
+        return "<table><tbody>%s</tbody></table>" % "".join(rows)
+
+    def _words(self, count):
+        return " ".join(self.random.choice(WORDS) for i in range(count))
+
+    def _date(self, version):
+        return "2013-%02d-%02d 10:00:00.000" % (version % 12 + 1, self.random.randint(1, 28))
+
+    def _prop(self, name, value):
+        return '<property name="%s"><![CDATA[%s]]></property>\n' % (name, value)
+
+    def _ref(self, name, objectClass, id):
+        return '<property name="%s" class="%s" package="com.atlassian.confluence"><id name="id">%s</id></property>\n' % (
+            name, objectClass, id)
+
+    def _collection(self, name, objectClass, ids):
+        elements = "".join('<element class="%s" package="com.atlassian.confluence"><id name="id">%s</id></element>' % (objectClass, id)
+                           for id in ids)
+        return '<collection name="%s" class="java.util.Collection">%s</collection>\n' % (name, elements)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic Confluence export')
+    parser.add_argument('--outputPath', type=str, default="testdata/export", help='The folder for entities.xml, the attachments and the users.')
+    parser.add_argument('--spaces', type=int, default=len(config.SPACES), help='The number of spaces (at least the ones of config.SPACES).')
+    parser.add_argument('--pages', type=int, default=100, help='The number of pages per space.')
+    parser.add_argument('--depth', type=int, default=4, help='The maximum depth of the page tree.')
+    parser.add_argument('--bodySize', type=int, default=2000, help='The approximate number of bytes of text per page.')
+    parser.add_argument('--tables', type=int, default=1, help='The number of tables per page.')
+    parser.add_argument('--tableRows', type=int, default=10, help='The number of rows per table.')
+    parser.add_argument('--tableColumns', type=int, default=4, help='The number of columns per table.')
+    parser.add_argument('--macros', type=int, default=2, help='The number of macros per page.')
+    parser.add_argument('--attachments', type=int, default=1, help='The number of attachments per page.')
+    parser.add_argument('--attachmentSize', type=int, default=10240, help='The size of each attachment in bytes.')
+    parser.add_argument('--versions', type=int, default=0, help='The number of old versions per page and attachment.')
+    parser.add_argument('--seed', type=int, default=1, help='The seed of the random generator.')
+    args = parser.parse_args()
+
+    if args.spaces < len(config.SPACES):
+        parser.error("--spaces must be at least %d, the converter expects all spaces of config.SPACES" % len(config.SPACES))
+    if args.pages < 1:
+        parser.error("--pages must be at least 1")
+    if args.depth < 1 and args.pages > 1:
+        parser.error("--depth must be at least 1 for more than one page per space")
+
+    generator = ExportGenerator(args.outputPath, spaces=args.spaces, pages=args.pages, depth=args.depth,
+                                bodySize=args.bodySize, tables=args.tables, tableRows=args.tableRows,
+                                tableColumns=args.tableColumns, macros=args.macros, attachments=args.attachments,
+                                attachmentSize=args.attachmentSize, versions=args.versions, seed=args.seed)
+    counts = generator.generate()
+    print("%(spaces)d spaces, %(pages)d pages, %(versions)d old versions, %(attachments)d attachments written." % counts)
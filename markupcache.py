@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of converted MoinMoin markup, addressed by the hash of the Confluence body.
+
+The entries are kept in a sub folder per translator version (see
+ConfluenceConverter.xmlparser.get_translator_version), so a change of the translation tables
+or the parser invalidates the cache. Folders of other versions (named by their hash) are
+removed on start, nothing else in the cache folder is touched.
+The cache is bounded by size, the least recently used entries are evicted first. The size is
+shared by the worker processes forked after the cache has been opened.
+"""
+
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+
+from ConfluenceConverter.xmlparser import get_translator_version
+
+VERSION_FOLDER_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+class MarkupCache():
+
+    def __init__(self, folder, maxBytes=1024 * 1024 * 1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+        version = get_translator_version()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for name in os.listdir(folder):
+            if name != version and VERSION_FOLDER_RE.match(name) is not None and os.path.isdir(os.path.join(folder, name)):
+                # translated by an older version of the parser
+                shutil.rmtree(os.path.join(folder, name))
+
+        self.versionFolder = os.path.join(folder, version)
+        if not os.path.isdir(self.versionFolder):
+            os.makedirs(self.versionFolder)
+        # bytes of all entries, updated by all processes
+        self._size = multiprocessing.Value("l", sum([size for path, size, mtime in self._entries()]))
+
+    def get(self, body):
+        """
+        :return: the cached markup (unicode) for the body or None
+        """
+        path = self._path(body)
+        try:
+            with open(path, "rb") as f:
+                markup = f.read().decode("utf-8")
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            # evicted by another process in the meantime, the markup is still valid
+            pass
+        self.hits += 1
+        return markup
+
+    def put(self, body, markup):
+        path = self._path(body)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+        if os.path.exists(path):
+            # put by another process in the meantime
+            return
+
+        if isinstance(markup, unicode):
+            markup = markup.encode("utf-8")
+        # write and rename, so other processes never read a partial entry
+        fd, tmpPath = tempfile.mkstemp(dir=folder, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(markup)
+        os.rename(tmpPath, path)
+
+        with self._size.get_lock():
+            self._size.value += len(markup)
+            if self._size.value > self.maxBytes:
+                self._evict()
+
+    def _path(self, body):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        key = hashlib.sha1(body).hexdigest()
+        return os.path.join(self.versionFolder, key[:2], key)
+
+    def _entries(self):
+        """
+        :return: (path, size, mtime) of all entries
+        """
+        entries = []
+        for folder, dirs, files in os.walk(self.versionFolder):
+            for name in files:
+                if name.startswith(".tmp"):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # evicted by another process
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache is filled to 90% at most.
+        Called with the lock of the size held, so only one process evicts at a time.
+        """
+        # the counted size is off if two processes put the same body at once, the disk is right
+        entries = self._entries()
+        entries.sort(key=lambda entry: entry[2])
+        size = sum([entrySize for path, entrySize, mtime in entries])
+        for path, entrySize, mtime in entries:
+            if size <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entrySize
+        self._size.value = size
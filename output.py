@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+"""
+Where the MoinMoinWriter puts the pages. All paths are relative to the folder of a page
+(e.g. "revisions/00000001" of the page "public(2f)Page").
+
+ * DirectoryOutput: writes directly into the output folder
+ * StagedOutput: builds the pages in a staging folder and publishes them in batches
+ * ArchiveOutput: writes the pages into a tar (optionally compressed) or zip file
+"""
+
+import os
+from os import makedirs, remove, rename
+from os.path import join, exists, dirname
+import errno
+import shutil
+import time
+import threading
+import tarfile
+import zipfile
+import StringIO
+import ctypes
+import ctypes.util
+
+import copyutil
+
+
+class DirectoryOutput():
+    """
+    Several pages may be written at the same time by different threads (or processes),
+    pageDone() is called by one thread only.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        # folders of the current page of each thread known to exist, saves a stat per file
+        self._local = threading.local()
+
+    def pageExists(self, pageName):
+        return exists(join(self.folder, pageName))
+
+    def createPage(self, pageName):
+        """
+        Claims the folder of a new page, fails if it exists already. Only one of several
+        threads or processes writing the same page gets it.
+        """
+        if not exists(self.folder):
+            try:
+                makedirs(self.folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._claimFolder(pageName, join(self.folder, pageName))
+        # removed again if the page fails
+        self._local.created = pageName
+
+    def readFile(self, pageName, path):
+        with open(self._readPath(pageName, path), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def writeFile(self, pageName, path, content):
+        self._writeBytes(self._targetPath(pageName, path), "wb", content)
+
+    def appendFile(self, pageName, path, content):
+        self._writeBytes(self._targetPath(pageName, path), "ab", content)
+
+    def copyFile(self, pageName, path, sourcePath, copyMode):
+        """
+        :return: the size of the file
+        """
+        targetPath = self._targetPath(pageName, path)
+        if exists(targetPath):
+            # never write through a hard link
+            remove(targetPath)
+        return copyutil.copyFile(sourcePath, targetPath, copyMode)
+
+    def pageDone(self, pageName):
+        """
+        Called when all files of the page have been written.
+        """
+        if getattr(self._local, "created", None) == pageName:
+            self._local.created = None
+
+    def discardPage(self, pageName):
+        """
+        Called if the page could not be written completely. A page created by this thread is
+        removed, the files written into an existing page stay.
+        """
+        if getattr(self._local, "created", None) == pageName:
+            shutil.rmtree(join(self.folder, pageName))
+            self._local.created = None
+            self._local.page = None
+
+    def close(self):
+        pass
+
+    def _readPath(self, pageName, path):
+        return join(self.folder, pageName, path)
+
+    def _claimFolder(self, pageName, folder):
+        try:
+            os.mkdir(folder)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise StandardError("Page %s already exists in output folder. Will not overwrite anything." % pageName)
+            raise
+
+    def _targetPath(self, pageName, path):
+        targetPath = join(self.folder, pageName, path)
+        self._makeFolder(pageName, dirname(targetPath))
+        return targetPath
+
+    def _makeFolder(self, pageName, folder):
+        local = self._local
+        if pageName != getattr(local, "page", None):
+            local.folders = set()
+            local.page = pageName
+        if folder in local.folders:
+            return
+        if not exists(folder):
+            try:
+                makedirs(folder)
+            except OSError as e:
+                # created by another thread in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
+        local.folders.add(folder)
+
+    def _writeBytes(self, filename, mode, content):
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        # one buffered write per file
+        with open(filename, mode) as f:
+            f.write(content)
+
+
+class StagedOutput(DirectoryOutput):
+    """
+    Writes the pages into a staging folder first, nobody reading the output folder ever
+    sees a partially written page.
+
+    Every 'batchSize' pages the file system is synced once and the pages are published:
+    new pages by renaming their folder into the output folder, changed pages by renaming
+    each new file over the old one, "current" last (MoinMoin reads the revision from it).
+    The staging folder must be on the same file system as the output folder. It is marked
+    with a MARKER file, only a marked folder is ever removed.
+    """
+
+    MARKER = ".wikiconverter-staging"
+
+    def __init__(self, folder, stagingFolder=None, batchSize=100):
+        DirectoryOutput.__init__(self, folder)
+        if stagingFolder is None:
+            stagingFolder = folder.rstrip("/") + ".staging"
+        self.stagingFolder = stagingFolder
+        self.batchSize = batchSize
+        self._batch = []
+
+        if exists(join(stagingFolder, StagedOutput.MARKER)):
+            # left over by an aborted run, never published
+            shutil.rmtree(stagingFolder)
+        elif exists(stagingFolder) and os.listdir(stagingFolder):
+            raise StandardError("The staging folder %s is not empty and has not been created by a conversion." % stagingFolder)
+        self._createdFolder = not exists(stagingFolder)
+        if self._createdFolder:
+            makedirs(stagingFolder)
+        with open(join(stagingFolder, StagedOutput.MARKER), "w") as f:
+            f.write("Staging folder of a running conversion, removed by the next one.\n")
+        if not exists(folder):
+            makedirs(folder)
+
+    def pageExists(self, pageName):
+        # a page of the current run may not be published yet
+        return exists(join(self.stagingFolder, pageName)) or DirectoryOutput.pageExists(self, pageName)
+
+    def createPage(self, pageName):
+        self._claimFolder(pageName, join(self.stagingFolder, pageName))
+        # published by an earlier batch or run
+        if DirectoryOutput.pageExists(self, pageName):
+            os.rmdir(join(self.stagingFolder, pageName))
+            raise StandardError("Page %s already exists in output folder. Will not overwrite anything." % pageName)
+
+    def readFile(self, pageName, path):
+        stagedPath = join(self.stagingFolder, pageName, path)
+        if exists(stagedPath):
+            with open(stagedPath, "rb") as f:
+                return f.read().decode("utf-8")
+        return DirectoryOutput.readFile(self, pageName, path)
+
+    def appendFile(self, pageName, path, content):
+        targetPath = self._targetPath(pageName, path)
+        livePath = join(self.folder, pageName, path)
+        if not exists(targetPath) and exists(livePath):
+            # the published file is replaced as a whole
+            shutil.copyfile(livePath, targetPath)
+        self._writeBytes(targetPath, "ab", content)
+
+    def pageDone(self, pageName):
+        self._batch.append(pageName)
+        if len(self._batch) >= self.batchSize:
+            self.publish()
+
+    def discardPage(self, pageName):
+        stagedPath = join(self.stagingFolder, pageName)
+        if exists(stagedPath):
+            shutil.rmtree(stagedPath)
+        self._local.page = None
+
+    def publish(self):
+        """
+        Moves the finished pages of the current batch into the output folder.
+        """
+        if not self._batch:
+            return
+
+        # the content must be on disk before it becomes visible
+        syncFileSystem(self.stagingFolder)
+        for pageName in self._batch:
+            stagedPath = join(self.stagingFolder, pageName)
+            livePath = join(self.folder, pageName)
+            if exists(livePath):
+                self._publishFiles(stagedPath, livePath)
+                shutil.rmtree(stagedPath)
+            else:
+                rename(stagedPath, livePath)
+        self._local.page = None
+        # and the renames as well
+        syncFileSystem(self.folder)
+        self._batch = []
+
+    def close(self):
+        self.publish()
+        if os.listdir(self.stagingFolder) == [StagedOutput.MARKER]:
+            remove(join(self.stagingFolder, StagedOutput.MARKER))
+            if self._createdFolder:
+                os.rmdir(self.stagingFolder)
+
+    def _publishFiles(self, stagedPath, livePath):
+        files = []
+        for folder, dirs, names in os.walk(stagedPath):
+            for name in names:
+                files.append(os.path.relpath(join(folder, name), stagedPath))
+        # the new revision, attachments and edit-log must be there, before "current" points to them
+        files.sort(key=lambda path: path == "current")
+        for path in files:
+            if not exists(dirname(join(livePath, path))):
+                makedirs(dirname(join(livePath, path)))
+            rename(join(stagedPath, path), join(livePath, path))
+
+    def _targetPath(self, pageName, path):
+        targetPath = join(self.stagingFolder, pageName, path)
+        self._makeFolder(pageName, dirname(targetPath))
+        return targetPath
+
+
+class ArchiveOutput():
+    """
+    Streams the pages into one archive with the layout "pages/<quoted page name>/...",
+    the attachments are read from the export directly into the archive.
+
+    The other files of a page are kept until pageDone(), a discarded page never gets a
+    "current" or revision into the archive. Its attachments are already in it, these pages
+    are reported by close().
+
+    Only new pages can be written, nothing can be read back or appended. The pages are
+    written by one thread, pageDone() may be called by another one.
+    """
+
+    # file name suffix -> format
+    FORMATS = (
+        (".tar.gz", "tar.gz"),
+        (".tgz", "tar.gz"),
+        (".tar.bz2", "tar.bz2"),
+        (".tar", "tar"),
+        (".zip", "zip")
+    )
+
+    def __init__(self, filename, format=None):
+        """
+        :param format: "tar", "tar.gz", "tar.bz2" or "zip", guessed from the file name if None
+        """
+        if format is None:
+            format = ArchiveOutput.guessFormat(filename)
+        if format is None:
+            raise StandardError("Unknown archive format of %s" % filename)
+
+        self.filename = filename
+        self.format = format
+        self._pages = set()
+        self._mtime = time.time()
+        # page name -> [(archive name, content)] of the files not written yet
+        self._pending = {}
+        # pages with attachments in the archive, not done yet
+        self._withAttachments = set()
+        # discarded pages with attachments in the archive
+        self._incomplete = []
+        self._lock = threading.Lock()
+
+        if format == "zip":
+            self._zip = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+            self._tar = None
+        else:
+            # stream mode, the file is written front to back only
+            self._tar = tarfile.open(filename, "w|" + format[len("tar."):])
+            self._zip = None
+
+    @staticmethod
+    def guessFormat(filename):
+        for suffix, format in ArchiveOutput.FORMATS:
+            if filename.endswith(suffix):
+                return format
+        return None
+
+    def pageExists(self, pageName):
+        return pageName in self._pages
+
+    def createPage(self, pageName):
+        if pageName in self._pages:
+            raise StandardError("Page %s already exists in the archive. Will not overwrite anything." % pageName)
+        self._pages.add(pageName)
+
+    def readFile(self, pageName, path):
+        raise StandardError("Can't read %s of page %s back from the archive." % (path, pageName))
+
+    def writeFile(self, pageName, path, content):
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        self._pages.add(pageName)
+        self._pending.setdefault(pageName, []).append((self._archiveName(pageName, path), content))
+
+    def appendFile(self, pageName, path, content):
+        raise StandardError("Can't append to %s of page %s in the archive." % (path, pageName))
+
+    def copyFile(self, pageName, path, sourcePath, copyMode):
+        """
+        :param copyMode: ignored, the file is always read into the archive
+        :return: the size of the file
+        """
+        self._pages.add(pageName)
+        self._withAttachments.add(pageName)
+        name = self._archiveName(pageName, path)
+        size = os.path.getsize(sourcePath)
+        with self._lock:
+            if self._zip is not None:
+                self._zip.write(sourcePath, name)
+            else:
+                with open(sourcePath, "rb") as f:
+                    self._tar.addfile(self._tarInfo(name, size), f)
+        return size
+
+    def pageDone(self, pageName):
+        self._withAttachments.discard(pageName)
+        with self._lock:
+            for name, content in self._pending.pop(pageName, []):
+                if self._zip is not None:
+                    self._zip.writestr(self._zipInfo(name), content)
+                else:
+                    self._tar.addfile(self._tarInfo(name, len(content)), StringIO.StringIO(content))
+
+    def discardPage(self, pageName):
+        self._pending.pop(pageName, None)
+        if pageName in self._withAttachments:
+            # already in the stream
+            self._withAttachments.discard(pageName)
+            self._incomplete.append(pageName)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        else:
+            self._tar.close()
+        if self._incomplete:
+            print("The attachments of %d failed pages are in the archive without the page: %s" % (
+                len(self._incomplete), ", ".join(sorted(self._incomplete))))
+
+    def _archiveName(self, pageName, path):
+        return "pages/%s/%s" % (pageName, path.replace(os.sep, "/"))
+
+    def _tarInfo(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self._mtime
+        info.mode = 0644
+        return info
+
+    def _zipInfo(self, name):
+        info = zipfile.ZipInfo(name, time.localtime(self._mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        return info
+
+
+_libc = None
+
+
+def syncFileSystem(path):
+    """
+    Flushes the file system containing 'path' with one syncfs call (all file systems
+    with sync if syncfs is not available).
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    if hasattr(_libc, "syncfs"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _libc.syncfs(fd) == 0:
+                return
+            err = ctypes.get_errno()
+            if err != errno.ENOSYS:
+                raise OSError(err, os.strerror(err))
+        finally:
+            os.close(fd)
+
+    _libc.sync()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time and memory measurements of a conversion run: the stages of the run (load, model,
+write, ...) and the translation of every single page.
+"""
+
+import os
+import time
+import resource
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+
+class StageTimer():
+    """
+    Records the wall and cpu time and the peak memory of each stage.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        startTimes = os.times()
+        start = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            endTimes = os.times()
+            self.stages.append({
+                "name": name,
+                "wall": wall,
+                # including the (finished) worker processes
+                "cpu": sum(endTimes[:4]) - sum(startTimes[:4]),
+                # ru_maxrss is in KB on Linux
+                "maxRssMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            })
+
+    def measure(self, name, function):
+        """
+        :return: the result of the function
+        """
+        with self.stage(name):
+            return function()
+
+
+class PageProfiler():
+    """
+    Records per page: the time spent on it, the translation time, the size of the
+    translated markup and of the copied attachments.
+
+    The page 'profilePageId' is run within cProfile, its stats are dumped to 'profileFile'.
+    """
+
+    def __init__(self, profilePageId=None, profileFile=None):
+        self.profilePageId = profilePageId
+        self.profileFile = profileFile
+        # page id -> {"seconds", "translateSeconds", "markupBytes", "attachmentBytes"}
+        self.pages = {}
+
+    def _get(self, pageId):
+        record = self.pages.get(pageId)
+        if record is None:
+            record = {"seconds": 0.0, "translateSeconds": 0.0, "markupBytes": 0, "attachmentBytes": 0}
+            self.pages[pageId] = record
+        return record
+
+    def runPage(self, pageId, function):
+        """
+        Calls function(pageId) and records the time.
+
+        :return: the result of the function
+        """
+        profile = None
+        if pageId == self.profilePageId:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.time()
+        try:
+            return function(pageId)
+        finally:
+            self._get(pageId)["seconds"] += time.time() - start
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.profileFile)
+
+    def addTranslation(self, pageId, seconds, markupBytes):
+        record = self._get(pageId)
+        record["translateSeconds"] += seconds
+        record["markupBytes"] += markupBytes
+
+    def addAttachment(self, pageId, size):
+        self._get(pageId)["attachmentBytes"] += size
+
+    def take(self, pageId):
+        """
+        :return: the record of the page (removed from this profiler) or None
+        """
+        return self.pages.pop(pageId, None)
+
+    def add(self, pageId, record):
+        """
+        Adds a record taken from the profiler of a worker process.
+        """
+        self.pages[pageId] = record
+
+    def slowest(self, count):
+        """
+        :return: (page id, record) of the pages with the longest translation time, slowest first
+        """
+        pages = sorted(self.pages.items(), key=lambda item: item[1]["translateSeconds"], reverse=True)
+        return pages[:count]
+
+
+def writeReport(filename, stages, pageProfiler, pages, top=20):
+    """
+    Writes the stages, the totals of all pages, the 'top' slowest pages and the cProfile
+    stats of the profiled page (if any) as text.
+
+    :param stages: StageTimer.stages
+    :param pages: page id -> Page, for the titles
+    """
+    with open(filename, "w") as f:
+        f.write("Stages\n")
+        for stage in stages:
+            f.write("  %(name)-10s wall %(wall)9.3fs  cpu %(cpu)9.3fs  max rss %(maxRssMB)8.1f MB\n" % stage)
+
+        records = pageProfiler.pages.values()
+        f.write("\nPages: %d, translation %.3fs, page total %.3fs, markup %d bytes, attachments %d bytes\n" % (
+            len(records),
+            sum([record["translateSeconds"] for record in records]),
+            sum([record["seconds"] for record in records]),
+            sum([record["markupBytes"] for record in records]),
+            sum([record["attachmentBytes"] for record in records])))
+
+        f.write("\nSlowest pages (translation)\n")
+        f.write("  %-12s %10s %10s %12s %14s  %s\n" % ("id", "translate", "total", "markup", "attachments", "title"))
+        for pageId, record in pageProfiler.slowest(top):
+            page = pages.get(pageId)
+            if page is None:
+                title = "?"
+            else:
+                title = page.fullName or page.title
+            if isinstance(title, unicode):
+                title = title.encode("utf-8")
+            f.write("  %-12s %9.3fs %9.3fs %12d %14d  %s\n" % (
+                pageId, record["translateSeconds"], record["seconds"], record["markupBytes"],
+                record["attachmentBytes"], title))
+
+        if pageProfiler.profileFile is not None and os.path.exists(pageProfiler.profileFile):
+            f.write("\ncProfile of page %s (%s)\n" % (pageProfiler.profilePageId, pageProfiler.profileFile))
+            stats = pstats.Stats(pageProfiler.profileFile, stream=f)
+            stats.sort_stats("cumulative").print_stats(30)
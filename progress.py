@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Periodic progress of a conversion run: objects parsed, pages written, attachment bytes,
+throughput and ETA. Printed and optionally appended as json lines to a file or written as
+a Prometheus textfile (for the node exporter textfile collector).
+"""
+
+import os
+import json
+import time
+
+PROMETHEUS_PREFIX = "wikiconverter_"
+
+
+class ProgressReporter():
+
+    def __init__(self, interval=10, jsonFile=None, prometheusFile=None):
+        """
+        :param interval: seconds between two reports
+        :param jsonFile: file the reports are appended to as json lines
+        :param prometheusFile: file replaced with the current metrics on each report
+        """
+        self.interval = interval
+        self.jsonFile = jsonFile
+        self.prometheusFile = prometheusFile
+
+        self.startTime = time.time()
+        self.phase = None
+        self.phaseStart = None
+        self.total = None
+        self.unit = None
+        self.done = 0
+        self.counters = {"objects": 0, "pages": 0, "failedPages": 0, "attachmentBytes": 0}
+        self._lastReport = 0
+
+    def startPhase(self, phase, total=None, unit="pages"):
+        """
+        :param total: the amount of work of this phase for the ETA
+        :param unit: the unit of the work (e.g. pages or bytes)
+        """
+        self.phase = phase
+        self.phaseStart = time.time()
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self._lastReport = 0
+        self.report()
+
+    def update(self, done=None, **counters):
+        """
+        Sets the done work of the phase and the given counters, reports if the interval is over.
+        """
+        if done is not None:
+            self.done = done
+        self.counters.update(counters)
+        if time.time() - self._lastReport >= self.interval:
+            self.report()
+
+    def finishPhase(self):
+        if self.total is not None:
+            self.done = self.total
+        self.report()
+
+    def rate(self):
+        """
+        :return: the done work of the phase per second
+        """
+        elapsed = time.time() - self.phaseStart
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def eta(self):
+        """
+        :return: the estimated seconds until the phase is done or None
+        """
+        rate = self.rate()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    def snapshot(self):
+        state = dict(self.counters)
+        state.update({
+            "time": time.time(),
+            "elapsed": time.time() - self.startTime,
+            "phase": self.phase,
+            "done": self.done,
+            "total": self.total,
+            "unit": self.unit,
+            "rate": self.rate(),
+            "eta": self.eta()
+        })
+        return state
+
+    def report(self):
+        self._lastReport = time.time()
+        state = self.snapshot()
+
+        print(self._formatLine(state))
+        if self.jsonFile is not None:
+            with open(self.jsonFile, "a") as f:
+                f.write(json.dumps(state, sort_keys=True) + "\n")
+        if self.prometheusFile is not None:
+            self._writePrometheus(state)
+
+    def _formatLine(self, state):
+        line = "[%(phase)s] %(objects)d objects parsed, %(pages)d pages written, %(attachmentBytes)d attachment bytes" % state
+        if state["total"] is not None:
+            line += ", %d/%d %s" % (state["done"], state["total"], state["unit"])
+        line += ", %.1f %s/s" % (state["rate"], state["unit"])
+        if state["eta"] is not None:
+            line += ", ETA %ds" % state["eta"]
+        return line
+
+    def _writePrometheus(self, state):
+        metrics = [
+            ("objects_parsed_total", "counter", "Objects parsed from the xml export", state["objects"]),
+            ("pages_written_total", "counter", "Pages written", state["pages"]),
+            ("pages_failed_total", "counter", "Pages that could not be converted", state["failedPages"]),
+            ("attachment_bytes_total", "counter", "Bytes of copied attachments", state["attachmentBytes"]),
+            ("phase_done", "gauge", "Done work of the current phase", state["done"]),
+            ("phase_total", "gauge", "Total work of the current phase", state["total"]),
+            ("phase_rate", "gauge", "Done work of the current phase per second", state["rate"]),
+            ("phase_eta_seconds", "gauge", "Estimated seconds until the current phase is done", state["eta"]),
+            ("last_progress_timestamp_seconds", "gauge", "Time of the last report", state["time"]),
+        ]
+
+        lines = []
+        for name, metricType, help, value in metrics:
+            if value is None:
+                continue
+            lines.append("# HELP %s%s %s" % (PROMETHEUS_PREFIX, name, help))
+            lines.append("# TYPE %s%s %s" % (PROMETHEUS_PREFIX, name, metricType))
+            lines.append("%s%s %s" % (PROMETHEUS_PREFIX, name, repr(float(value))))
+        lines.append('# TYPE %sphase gauge' % PROMETHEUS_PREFIX)
+        lines.append('%sphase{phase="%s"} 1' % (PROMETHEUS_PREFIX, self.phase))
+
+        # the collector must never read a partial file
+        tmpFilename = self.prometheusFile + ".tmp"
+        with open(tmpFilename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmpFilename, self.prometheusFile)
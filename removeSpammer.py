@@ -2,56 +2,236 @@
 # -*- coding: utf-8 -*-
 
 # remove the 16.xxx spam user
+#
+# Every user file, whose user is not in the list of valid users, is moved to another folder.
+# With deny rules (regular expressions or heuristics) only the matching users are moved.
+# The moved files are recorded in a manifest, so the moves can be undone.
+
 from os import listdir, path
+import os
 import re
+import errno
+import json
+import time
+import argparse
 from shutil import move
+from multiprocessing.pool import ThreadPool
 
+import userindex
 
-def action(folder, valid_users, move_to):
-    if not path.isdir(folder):
-        raise StandardError("no folder: %s" % folder)
-    if not path.isdir(move_to):
-        raise StandardError("no folder: %s" % move_to)
-
-    USER_FILE_RE = re.compile(r'^[0-9\.]+$')
-    for file in listdir(folder):
-        if path.isdir(file): continue
-        if USER_FILE_RE.match(file) is None: continue
-        user_file = path.join(folder, file)
-        name = getNameFromUserFile(user_file)
-        if name in valid_users:
-            print "ok -> %s" % name
-        else:
-            print "move -> %s" % name
-            move(user_file, move_to)
+MANIFEST_PREFIX = "removed-"
 
+# name -> (description, function(user data) returning True for a spammer)
+HEURISTICS = {
+    "url": ("name or alias name contains a link",
+            lambda data: re.search(r'https?:|www\.|\.(com|net|ru|info)\b', data.get("name", "") + " " + data.get("aliasname", "")) is not None),
+    "digits": ("name ends with 4 or more digits",
+               lambda data: re.search(r'[0-9]{4,}$', data.get("name", "")) is not None),
+    "noemail": ("no email address",
+                lambda data: not data.get("email", "").strip()),
+}
 
-def getNameFromUserFile(file):
-    lookingFor = "name="
-    with open(file, "r") as file:
-        for line in file:
-            if line.startswith(lookingFor):
-                # remove the newline also
-                return line[len(lookingFor):len(line) - 1]
 
-    raise BaseException("No name= entry found!")
+def readUserFile(file):
+    """
+    :return: the key=value entries of a MoinMoin user file
+    """
+    data = {}
+    with open(file, "r") as f:
+        for line in f:
+            if line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.rstrip("\n").split("=", 1)
+            data[key] = value
+    if not data.has_key("name"):
+        raise BaseException("No name= entry found!")
+    return data
 
 
 def read_valid_users(file):
-    u = []
+    u = set()
     with open(file, "r") as f:
         for line in f:
             line = line.strip()
             if len(line) > 0:
-                u.append(line)
+                u.add(line)
 
     return u
 
 
+class Triage():
+    """
+    Decides for every user file whether the user is kept or moved:
+
+     * users in the allowlist (valid users) are always kept
+     * without deny rules every other user is moved
+     * with deny rules only users matching one of them are moved
+    """
+
+    def __init__(self, valid_users, deny_patterns=None, heuristics=None):
+        self.valid_users = set(valid_users)
+        self.deny_patterns = [re.compile(pattern) for pattern in (deny_patterns or [])]
+        self.heuristics = [(name, HEURISTICS[name][1]) for name in (heuristics or [])]
+
+    def decide(self, data):
+        """
+        :return: (move, reason)
+        """
+        name = data["name"]
+        if name in self.valid_users:
+            return False, "valid user"
+        if not self.deny_patterns and not self.heuristics:
+            return True, "not a valid user"
+
+        for pattern in self.deny_patterns:
+            if pattern.search(name):
+                return True, "deny pattern %s" % pattern.pattern
+        for heuristic, matches in self.heuristics:
+            if matches(data):
+                return True, "heuristic %s" % heuristic
+        return False, "no deny rule matched"
+
+
+def scan(folder, triage, threads=8):
+    """
+    Reads all user files of the folder in parallel.
+
+    :return: a list of (file, name, move, reason), in the order of the folder
+    """
+    files = [file for file in listdir(folder)
+             if userindex.USER_FILE_RE.match(file) is not None and not path.isdir(path.join(folder, file))]
+
+    def check(file):
+        data = readUserFile(path.join(folder, file))
+        move, reason = triage.decide(data)
+        return file, data["name"], move, reason
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(check, files)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summary(results):
+    """
+    :return: reason -> (move, count)
+    """
+    counts = {}
+    for file, name, move, reason in results:
+        count = counts.get(reason, (move, 0))[1]
+        counts[reason] = (move, count + 1)
+    return counts
+
+
+def moveFile(source, target):
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # another file system
+        move(source, target)
+
+
+def moveUsers(folder, results, move_to, batch_size=500):
+    """
+    Moves the files of all users to be moved. Each batch is written to the manifest first,
+    so an interrupted run can be undone as well.
+
+    :return: the manifest file
+    """
+    manifest = path.join(move_to, MANIFEST_PREFIX + time.strftime("%Y%m%d-%H%M%S") + ".jsonl")
+    toMove = [(file, name, reason) for file, name, move, reason in results if move]
+
+    with open(manifest, "a") as f:
+        for start in range(0, len(toMove), batch_size):
+            batch = toMove[start:start + batch_size]
+            for file, name, reason in batch:
+                f.write(json.dumps({"file": file, "name": name.decode("utf-8", "replace"), "reason": reason,
+                                    "from": path.abspath(folder), "to": path.abspath(move_to)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+            for file, name, reason in batch:
+                moveFile(path.join(folder, file), path.join(move_to, file))
+            print("%d/%d moved" % (start + len(batch), len(toMove)))
+
+    return manifest
+
+
+def undo(manifest):
+    """
+    Moves the files listed in the manifest back, files already there again are skipped.
+    """
+    restored = 0
+    skipped = 0
+    with open(manifest, "r") as f:
+        for line in f:
+            entry = json.loads(line)
+            source = path.join(entry["to"], entry["file"])
+            target = path.join(entry["from"], entry["file"])
+            if path.exists(target) or not path.exists(source):
+                skipped += 1
+                continue
+            moveFile(source, target)
+            restored += 1
+
+    os.rename(manifest, manifest + ".undone")
+    print("%d users restored, %d skipped." % (restored, skipped))
+
+
+def action(folder, valid_users, move_to, deny_patterns=None, heuristics=None, dry_run=False, threads=8, batch_size=500):
+    if not path.isdir(folder):
+        raise StandardError("no folder: %s" % folder)
+    if not dry_run and not path.isdir(move_to):
+        raise StandardError("no folder: %s" % move_to)
+
+    triage = Triage(valid_users, deny_patterns, heuristics)
+    results = scan(folder, triage, threads)
+
+    counts = summary(results)
+    for reason in sorted(counts.keys()):
+        move, count = counts[reason]
+        print("%-6s %7d  %s" % ("move" if move else "keep", count, reason))
+    print("%d users to move, %d to keep." % (
+        sum([count for move, count in counts.values() if move]), sum([count for move, count in counts.values() if not move])))
+
+    if dry_run:
+        return None
+
+    manifest = moveUsers(folder, results, move_to, batch_size)
+    print("Manifest written to %s, undo with --undo." % manifest)
+    return manifest
+
+
 if __name__ == '__main__':
-    action(
-        folder="testdata/spammer",
-        valid_users=read_valid_users('valid_users'),
-        move_to="testdata/spammer/disabled"
-    )
 
+    parser = argparse.ArgumentParser(description='Move spam users out of the MoinMoin user folder')
+    parser.add_argument('--usersPath', type=str, default="testdata/spammer", help='The MoinMoin user folder.')
+    parser.add_argument('--validUsers', type=str, default="valid_users", help='File with the names of the valid users (one per line), they are never moved.')
+    parser.add_argument('--moveTo', type=str, default="testdata/spammer/disabled", help='The folder the spam users are moved to.')
+    parser.add_argument('--deny', type=str, action='append', help='Only move users whose name matches this regular expression (may be given more than once).')
+    parser.add_argument('--heuristic', choices=sorted(HEURISTICS.keys()), action='append',
+                        help='Only move users matching this heuristic (may be given more than once): ' +
+                             ", ".join("%s: %s" % (name, HEURISTICS[name][0]) for name in sorted(HEURISTICS.keys())))
+    parser.add_argument('--dryRun', action='store_true', help='Only print what would be moved.')
+    parser.add_argument('--threads', type=int, default=8, help='The number of threads reading the user files.')
+    parser.add_argument('--batchSize', type=int, default=500, help='The number of users moved per manifest batch.')
+    parser.add_argument('--undo', type=str, metavar="MANIFEST", help='Move the users listed in this manifest back.')
+    args = parser.parse_args()
+
+    if args.undo is not None:
+        undo(args.undo)
+    else:
+        action(
+            folder=args.usersPath,
+            valid_users=read_valid_users(args.validUsers),
+            move_to=args.moveTo,
+            deny_patterns=args.deny,
+            heuristics=args.heuristic,
+            dry_run=args.dryRun,
+            threads=args.threads,
+            batch_size=args.batchSize
+        )
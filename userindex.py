@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index of the MoinMoin user files: user name -> user id (= file name).
+
+The index is kept as a json file within the users folder, together with the mtime of the
+folder. It is valid as long as the folder has not been modified since (a new, removed or
+renamed user file changes the mtime of the folder). Otherwise the folder is scanned again, with
+a pool of threads reading the user files.
+"""
+
+import os
+from os import listdir
+from os.path import join, getmtime
+import re
+import json
+from multiprocessing.pool import ThreadPool
+
+USER_FILE_RE = re.compile(r'^[0-9\.]+$')
+
+INDEX_FILENAME = "name-index.json"
+
+
+def getNameFromUserFile(file):
+    lookingFor = "name="
+    with open(file, "r") as file:
+        for line in file:
+            if line.startswith(lookingFor):
+                # remove the newline also
+                return line[len(lookingFor):len(line) - 1]
+
+    raise BaseException("No name= entry found!")
+
+
+def scanFolder(folder, threads=8, known=None):
+    """
+    Reads the names of all user files.
+
+    :param known: user id -> name of user files, which don't need to be read
+    :return: user name -> user id
+    """
+    if known is None:
+        known = {}
+    userIds = [file for file in listdir(folder) if USER_FILE_RE.match(file) is not None]
+    unknownIds = [userId for userId in userIds if not known.has_key(userId)]
+
+    pool = ThreadPool(threads)
+    try:
+        names = dict(zip(unknownIds, pool.map(lambda userId: getNameFromUserFile(join(folder, userId)), unknownIds)))
+    finally:
+        pool.close()
+        pool.join()
+    names.update(known)
+
+    users = {}
+    # in directory order, like a sequential scan
+    for userId in userIds:
+        users[names[userId]] = userId
+    return users
+
+
+def readIndex(folder):
+    """
+    :return: user name -> user id or None if there is no valid index
+    """
+    indexFile = join(folder, INDEX_FILENAME)
+    try:
+        with open(indexFile, "r") as f:
+            index = json.load(f)
+        if not isinstance(index, dict) or not isinstance(index.get("users"), dict):
+            # not written by writeIndex
+            return None
+        if index.get("folderMtime") != getmtime(folder):
+            # user files have been added or removed since
+            return None
+    except (OSError, IOError, ValueError):
+        return None
+
+    users = {}
+    for name, userId in index["users"].items():
+        users[name.encode("utf-8")] = str(userId)
+    return users
+
+
+def writeIndex(folder, users):
+    """
+    :param users: user name -> user id
+    :raise UnicodeDecodeError: if a name is not utf-8 (e.g. of a legacy user file), nothing is written then
+    """
+    # fails before anything is written
+    json.dumps(users)
+
+    indexFile = join(folder, INDEX_FILENAME)
+    tmpFile = indexFile + ".tmp"
+    with open(tmpFile, "w") as f:
+        json.dump({"folderMtime": None, "users": users}, f)
+    os.rename(tmpFile, indexFile)
+
+    # the rename itself modified the folder, rewriting the file in place doesn't
+    with open(indexFile, "w") as f:
+        json.dump({"folderMtime": getmtime(folder), "users": users}, f)
+
+
+def loadUsers(folder, threads=8):
+    """
+    :return: user name -> user id, from the index or (if stale) from the user files
+    """
+    users = readIndex(folder)
+    if users is not None:
+        return users
+
+    users = scanFolder(folder, threads)
+    try:
+        writeIndex(folder, users)
+    except (OSError, IOError, UnicodeDecodeError) as e:
+        print("Can't write the user index: %s" % e)
+    return users